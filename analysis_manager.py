@@ -2,6 +2,7 @@
 Менеджер задач анализа с возможностью отмены
 """
 
+import os
 import sqlite3
 import threading
 import time
@@ -9,6 +10,7 @@ import logging
 from datetime import datetime
 from typing import Optional, Dict, Any
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +18,13 @@ class AnalysisManager:
     """Менеджер для управления задачами анализа"""
     
     def __init__(self):
-        self.active_tasks = {}  # task_id -> {'thread': thread, 'cancelled': bool}
+        self.active_tasks = {}  # task_id -> {'future': future, 'cancelled': bool}
         self.lock = threading.Lock()
+        # Ограниченный пул: лишние задачи ждут в очереди, а не запускают новый поток
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('ANALYSIS_WORKERS', os.cpu_count() or 2)),
+            thread_name_prefix='analysis'
+        )
     
     def create_task(self, user_id: int, filename: str) -> int:
         """Создание новой задачи анализа"""
@@ -139,7 +146,7 @@ class AnalysisManager:
             conn.close()
     
     def start_analysis_task(self, task_id: int, user_id: int, filepath: str, filename: str, page_range: str = None):
-        """Запуск задачи анализа в отдельном потоке"""
+        """Запуск задачи анализа в пуле потоков"""
         def analysis_worker():
             try:
                 logger.info(f"Starting analysis task {task_id}")
@@ -230,20 +237,17 @@ class AnalysisManager:
                 else:
                     logger.warning(f"⚠️ File not found for deletion after error: {filepath}")
         
-        # Создаем и запускаем поток
-        thread = threading.Thread(target=analysis_worker, daemon=True)
-        
+        # Ставим задачу в пул под блокировкой: воркер не увидит задачу раньше ее записи
         with self.lock:
             self.active_tasks[task_id] = {
-                'thread': thread,
+                'future': self.executor.submit(analysis_worker),
                 'cancelled': False
             }
         
-        thread.start()
-        logger.info(f"Started analysis task {task_id} in background thread")
+        logger.info(f"Started analysis task {task_id} in analysis pool")
 
     def start_video_analysis_task(self, task_id: int, user_id: int, filepath: str, filename: str, video_info: dict = None):
-        """Запуск задачи анализа видео в отдельном потоке"""
+        """Запуск задачи анализа видео в пуле потоков"""
         def video_analysis_worker():
             try:
                 logger.info(f"Starting video analysis task {task_id}")
@@ -336,17 +340,14 @@ class AnalysisManager:
                 else:
                     logger.warning(f"⚠️ Video file not found for deletion after error: {filepath}")
         
-        # Создаем и запускаем поток
-        thread = threading.Thread(target=video_analysis_worker, daemon=True)
-        
+        # Ставим задачу в пул под блокировкой: воркер не увидит задачу раньше ее записи
         with self.lock:
             self.active_tasks[task_id] = {
-                'thread': thread,
+                'future': self.executor.submit(video_analysis_worker),
                 'cancelled': False
             }
         
-        thread.start()
-        logger.info(f"Started video analysis task {task_id} in background thread")
+        logger.info(f"Started video analysis task {task_id} in analysis pool")
     
     def update_task_progress(self, task_id: int, progress: int, stage: str, details: str = ""):
         """Обновление прогресса задачи"""
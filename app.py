@@ -1,8 +1,21 @@
 import os
+import io
 import json
 import sqlite3
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, session, send_from_directory
+import orjson
+import json_repair
+import queue
+import threading
+import time
+import atexit
+import copy
+import itertools
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from cachetools import TTLCache
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Request, Response, render_template, request, redirect, url_for, flash, send_file, jsonify, session, send_from_directory
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from usage_tracking import usage_tracker
@@ -11,65 +24,59 @@ from migration_manager import run_migrations
 from analytics import element_analytics
 from subscription_manager import subscription_manager, SUBSCRIPTION_PLANS
 from subscription_decorators import require_subscription_limit, track_usage, subscription_required
-from gamification import gamification
+from gamification import gamification, ACHIEVEMENTS
 from smart_upgrade_triggers import smart_triggers
 from analytics_manager import analytics_manager
 from analysis_manager import analysis_manager
+import db
+from db import get_db, get_conn
+
+# Email администраторов (через запятую в ADMIN_EMAILS)
+ADMIN_EMAILS = frozenset(
+    email.strip().lower()
+    for email in os.environ.get('ADMIN_EMAILS', 'test@test.ru').split(',')
+    if email.strip()
+)
 
 # Функция проверки прав администратора
 def is_admin(user):
     """Проверка, является ли пользователь администратором"""
-    if not user or not user.is_authenticated:
-        return False
-    return user.email == 'test@test.ru'
+    return bool(user and user.is_authenticated and user.email in ADMIN_EMAILS)
 
 def get_user_learning_stats(user_id):
     """Получение персональной статистики обучения пользователя"""
-    conn = sqlite3.connect('ai_study.db')
+    conn = get_db()
     c = conn.cursor()
     
-    # Общая статистика пользователя
-    c.execute('''
-        SELECT COUNT(*) FROM result WHERE user_id = ?
-    ''', (user_id,))
-    total_results = c.fetchone()[0]
-    
-    # Статистика по флеш-картам
-    c.execute('''
-        SELECT COUNT(*) FROM user_progress 
-        WHERE user_id = ? AND consecutive_correct >= 3
-    ''', (user_id,))
-    mastered_cards = c.fetchone()[0]
-    
-    c.execute('''
-        SELECT COUNT(*) FROM user_progress WHERE user_id = ?
-    ''', (user_id,))
-    total_cards_studied = c.fetchone()[0]
-    
-    # Карточки для повторения сегодня
-    c.execute('''
-        SELECT COUNT(*) FROM user_progress 
-        WHERE user_id = ? AND date(next_review) <= date('now')
-    ''', (user_id,))
-    cards_due_today = c.fetchone()[0]
-    
-    # Статистика по типам файлов
-    c.execute('''
+    # Статистика по типам файлов; общее число результатов - их сумма
+    file_types = {file_type: count for file_type, count in c.execute('''
         SELECT file_type, COUNT(*) 
         FROM result 
         WHERE user_id = ? 
         GROUP BY file_type
+    ''', (user_id,))}
+    total_results = sum(file_types.values())
+    
+    # Статистика по флеш-картам одним проходом по user_progress
+    c.execute('''
+        SELECT COUNT(*),
+               COALESCE(SUM(consecutive_correct >= 3), 0),
+               COALESCE(SUM(date(next_review) <= date('now')), 0)
+        FROM user_progress
+        WHERE user_id = ?
     ''', (user_id,))
-    file_types = dict(c.fetchall())
+    total_cards_studied, mastered_cards, cards_due_today = c.fetchone()
     
-    # Активность за последние 30 дней
+    # Активность за последние 30 дней; граница передается параметром (UTC, как date('now'))
+    # и дает диапазонный поиск по индексу (user_id, created_at)
+    activity_since = (datetime.now(timezone.utc) - timedelta(days=30)).strftime('%Y-%m-%d')
     c.execute('''
         SELECT DATE(created_at) as date, COUNT(*) as count
         FROM result 
-        WHERE user_id = ? AND created_at >= date('now', '-30 days')
+        WHERE user_id = ? AND created_at >= ?
         GROUP BY DATE(created_at)
         ORDER BY date DESC
-    ''', (user_id,))
+    ''', (user_id, activity_since))
     recent_activity = c.fetchall()
     
     # Прогресс изучения (на основе флеш-карт)
@@ -84,9 +91,12 @@ def get_user_learning_stats(user_id):
     targets = calculate_user_targets(user_id, total_results, mastered_cards, total_cards_studied)
     
     # Персональные учебные сессии
-    study_sessions = get_or_create_user_study_sessions(user_id)
-    
-    conn.close()
+    study_sessions = get_or_create_user_study_sessions(
+        user_id,
+        mastered_cards=mastered_cards,
+        total_cards_studied=total_cards_studied,
+        total_results=total_results
+    )
     
     return {
         'total_results': total_results,
@@ -101,82 +111,94 @@ def get_user_learning_stats(user_id):
         'study_sessions': study_sessions
     }
 
+# Контрольные точки: (название, описание, показатель, цель, с какого значения "current", подпись)
+CHECKPOINT_DEFS = (
+    ('Первые шаги', 'Загрузка и анализ первых файлов', 'total_results', 3, 1, 'файлов'),
+    ('Активное изучение', 'Работа с флеш-картами и повторения', 'total_cards_studied', 20, 1, 'карточек'),
+    ('Достижение мастерства', 'Освоение материала и закрепление знаний', 'mastered_cards', 10, 1, 'освоенных'),
+    ('Экспертный уровень', 'Глубокое изучение разнообразных материалов', 'total_results', 10, 5, 'файлов'),
+)
+
 def calculate_user_checkpoints(user_id, total_results, mastered_cards, total_cards_studied):
     """Расчет персональных контрольных точек пользователя"""
-    checkpoints = []
-    
-    # Контрольная точка 1: Первые шаги
-    first_progress = min(100, (total_results / 3) * 100) if total_results > 0 else 0
-    checkpoints.append({
-        'title': 'Первые шаги',
-        'description': 'Загрузка и анализ первых файлов',
-        'progress': int(first_progress),
-        'status': 'completed' if total_results >= 3 else ('current' if total_results > 0 else 'upcoming'),
-        'target': f'{min(total_results, 3)}/3 файлов'
-    })
-    
-    # Контрольная точка 2: Активное изучение
-    study_progress = min(100, (total_cards_studied / 20) * 100) if total_cards_studied > 0 else 0
-    checkpoints.append({
-        'title': 'Активное изучение',
-        'description': 'Работа с флеш-картами и повторения',
-        'progress': int(study_progress),
-        'status': 'completed' if total_cards_studied >= 20 else ('current' if total_cards_studied > 0 else 'upcoming'),
-        'target': f'{min(total_cards_studied, 20)}/20 карточек'
-    })
-    
-    # Контрольная точка 3: Мастерство
-    mastery_progress = min(100, (mastered_cards / 10) * 100) if mastered_cards > 0 else 0
-    checkpoints.append({
-        'title': 'Достижение мастерства',
-        'description': 'Освоение материала и закрепление знаний',
-        'progress': int(mastery_progress),
-        'status': 'completed' if mastered_cards >= 10 else ('current' if mastered_cards > 0 else 'upcoming'),
-        'target': f'{min(mastered_cards, 10)}/10 освоенных'
-    })
-    
-    # Контрольная точка 4: Эксперт
-    expert_progress = min(100, (total_results / 10) * 100) if total_results > 0 else 0
-    checkpoints.append({
-        'title': 'Экспертный уровень',
-        'description': 'Глубокое изучение разнообразных материалов',
-        'progress': int(expert_progress),
-        'status': 'completed' if total_results >= 10 else ('current' if total_results >= 5 else 'upcoming'),
-        'target': f'{min(total_results, 10)}/10 файлов'
-    })
-    
-    return checkpoints
+    values = {
+        'total_results': total_results,
+        'mastered_cards': mastered_cards,
+        'total_cards_studied': total_cards_studied
+    }
+    return [
+        {
+            'title': title,
+            'description': description,
+            'progress': min(100, value * 100 // target),
+            'status': 'completed' if value >= target else ('current' if value >= current_from else 'upcoming'),
+            'target': f'{min(value, target)}/{target} {unit}'
+        }
+        for title, description, key, target, current_from, unit in CHECKPOINT_DEFS
+        for value in (values[key],)
+    ]
 
 def calculate_user_targets(user_id, total_results, mastered_cards, total_cards_studied):
     """Расчет персональных целевых показателей"""
-    targets = []
-    
     # Цель 1: Удержание знаний
-    retention_rate = 0
-    if total_cards_studied > 0:
-        retention_rate = min(100, int((mastered_cards / total_cards_studied) * 100))
-    
-    targets.append({
-        'label': 'Удержание знаний',
-        'value': f'{retention_rate}%',
-        'progress': retention_rate,
-        'color': 'success' if retention_rate >= 70 else ('warning' if retention_rate >= 50 else 'danger')
-    })
+    retention_rate = min(100, mastered_cards * 100 // total_cards_studied) if total_cards_studied > 0 else 0
     
     # Цель 2: Активность изучения
-    activity_rate = min(100, (total_results / 5) * 100) if total_results > 0 else 0
-    targets.append({
-        'label': 'Активность изучения',
-        'value': f'{int(activity_rate)}%',
-        'progress': int(activity_rate),
-        'color': 'info' if activity_rate >= 80 else ('warning' if activity_rate >= 40 else 'danger')
-    })
+    activity_rate = min(100, total_results * 100 // 5)
     
-    return targets
+    return [
+        {
+            'label': 'Удержание знаний',
+            'value': f'{retention_rate}%',
+            'progress': retention_rate,
+            'color': 'success' if retention_rate >= 70 else ('warning' if retention_rate >= 50 else 'danger')
+        },
+        {
+            'label': 'Активность изучения',
+            'value': f'{activity_rate}%',
+            'progress': activity_rate,
+            'color': 'info' if activity_rate >= 80 else ('warning' if activity_rate >= 40 else 'danger')
+        }
+    ]
+
+def format_db_date(value):
+    """Дата 'ДД.ММ.ГГГГ' из временной метки SQLite 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' (срезами, без strptime)"""
+    if len(value) < 10 or value[4] != '-' or value[7] != '-':
+        raise ValueError(f"Unexpected timestamp format: {value!r}")
+    return f'{value[8:10]}.{value[5:7]}.{value[0:4]}'
 
-def get_or_create_user_study_sessions(user_id):
+def _short_name(name, limit=30):
+    """Имя файла, обрезанное до limit символов с многоточием"""
+    return name if len(name) <= limit else f'{name[:limit]}...'
+
+# Текст действия учебной сессии по ее статусу
+_SESSION_ACTION_TEXT = {'completed': 'Повторить', 'in_progress': 'Продолжить'}
+
+def _row_to_session(row):
+    """Преобразование строки study_sessions в словарь для дашборда"""
+    (session_id, title, description, phase, difficulty, duration_minutes, status,
+     created_at, started_at, completed_at, result_id, session_type) = row
+    return {
+        'id': session_id,
+        'phase': phase,
+        'phase_class': f'phase-{phase.lower()}',
+        'title': title,
+        'description': description,
+        'date': format_db_date(created_at),
+        'duration': f'{duration_minutes} мин',
+        'difficulty': difficulty,
+        'difficulty_class': f'difficulty-{difficulty}',
+        'status': status,
+        'action_text': _SESSION_ACTION_TEXT.get(status, 'Начать'),
+        'result_id': result_id,
+        'session_type': session_type,
+        'started_at': started_at,
+        'completed_at': completed_at
+    }
+
+def get_or_create_user_study_sessions(user_id, *, mastered_cards=None, total_cards_studied=None, total_results=None):
     """Получение или создание персональных учебных сессий пользователя"""
-    conn = sqlite3.connect('ai_study.db')
+    conn = get_db()
     c = conn.cursor()
     
     logger.info(f"Getting study sessions for user {user_id}")
@@ -198,44 +220,31 @@ def get_or_create_user_study_sessions(user_id):
         # Если сессии уже есть, проверяем, нужно ли добавить новые
         logger.info(f"Found existing sessions, checking for new files for user {user_id}")
         
-        # Получаем ID файлов, для которых уже есть сессии
-        existing_result_ids = set()
-        for row in existing_sessions:
-            result_id = row[10]  # result_id
-            if result_id:
-                existing_result_ids.add(result_id)
-        
-        # Получаем все файлы пользователя
+        # Файлы пользователя, для которых еще нет сессий (не больше 5 за раз)
         c.execute('''
-            SELECT id, filename, file_type, created_at 
-            FROM result 
-            WHERE user_id = ? 
-            ORDER BY created_at ASC
+            SELECT r.id, r.filename, r.file_type, r.created_at
+            FROM result r
+            LEFT JOIN study_sessions s ON s.result_id = r.id AND s.user_id = r.user_id
+            WHERE r.user_id = ? AND s.id IS NULL
+            ORDER BY r.created_at ASC
+            LIMIT 5
         ''', (user_id,))
-        
-        all_user_files = c.fetchall()
-        
-        # Находим файлы без сессий
-        new_files = []
-        for file_data in all_user_files:
-            if file_data[0] not in existing_result_ids:  # file_data[0] это id
-                new_files.append(file_data)
+        new_files = c.fetchall()
         
         # Создаем сессии для новых файлов
         if new_files:
             logger.info(f"Creating sessions for {len(new_files)} new files")
             
-            # Получаем статистику для определения статуса новых сессий
-            c.execute('''
-                SELECT COUNT(*) FROM user_progress 
-                WHERE user_id = ? AND consecutive_correct >= 3
-            ''', (user_id,))
-            mastered_cards = c.fetchone()[0]
+            # Новые сессии дописываются в конец списка без повторного SELECT
+            existing_sessions = list(existing_sessions)
+            # created_at в формате и часовом поясе CURRENT_TIMESTAMP
+            created_at_now = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
             
             # Определяем следующий номер сессии
             next_session_number = len([s for s in existing_sessions if s[11] == 'study']) + 1  # session_type == 'study'
             
-            for file_data in new_files[:5]:  # Максимум 5 новых сессий
+            new_rows = []
+            for file_data in new_files:
                 result_id, filename, file_type, created_at = file_data
                 
                 # Определяем фазу на основе номера
@@ -247,70 +256,32 @@ def get_or_create_user_study_sessions(user_id):
                     phase = 'МАСТЕРСТВО'
                 
                 # Создаем персональную сессию на основе файла
-                file_name_short = filename[:30] + '...' if len(filename) > 30 else filename
-                title = f'Сессия {next_session_number}: Изучение "{file_name_short}"'
+                title = f'Сессия {next_session_number}: Изучение "{_short_name(filename)}"'
                 description = f'Работа с материалом из файла {file_type.upper()}'
                 difficulty = 'легкий' if next_session_number == 1 else ('средний' if next_session_number <= 3 else 'сложный')
                 status = 'available'
                 
-                # Сохраняем новую сессию в базу данных
-                c.execute('''
-                    INSERT INTO study_sessions 
-                    (user_id, result_id, session_type, title, description, phase, difficulty, duration_minutes, status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (user_id, result_id, 'study', title, description, phase, difficulty, 45, status))
-                
+                new_rows.append((user_id, result_id, 'study', title, description, phase, difficulty, 45, status, created_at_now))
                 next_session_number += 1
             
-            conn.commit()
+            # Сохраняем новые сессии одним executemany; rowid внутри транзакции идут подряд
+            c.executemany('''
+                INSERT INTO study_sessions 
+                (user_id, result_id, session_type, title, description, phase, difficulty, duration_minutes, status, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', new_rows)
+            first_id = c.execute('SELECT last_insert_rowid()').fetchone()[0] - len(new_rows) + 1
             
-            # Перезапрашиваем все сессии после добавления новых
-            c.execute('''
-                SELECT id, title, description, phase, difficulty, duration_minutes, 
-                       status, created_at, started_at, completed_at, result_id, session_type
-                FROM study_sessions 
-                WHERE user_id = ? 
-                ORDER BY created_at ASC
-            ''', (user_id,))
+            for session_id, (_, result_id, session_type, title, description, phase, difficulty,
+                             duration_minutes, status, created_at) in enumerate(new_rows, first_id):
+                existing_sessions.append((session_id, title, description, phase, difficulty, duration_minutes,
+                                          status, created_at, None, None, result_id, session_type))
             
-            existing_sessions = c.fetchall()
+            conn.commit()
         
         # Формируем список всех сессий для возврата
-        sessions = []
-        for row in existing_sessions:
-            session_id, title, description, phase, difficulty, duration_minutes, status, created_at, started_at, completed_at, result_id, session_type = row
-            
-            # Определяем класс фазы
-            phase_class = f'phase-{phase.lower()}'
-            difficulty_class = f'difficulty-{difficulty}'
-            
-            # Определяем текст действия на основе статуса
-            if status == 'completed':
-                action_text = 'Повторить'
-            elif status == 'in_progress':
-                action_text = 'Продолжить'
-            else:
-                action_text = 'Начать'
-            
-            sessions.append({
-                'id': session_id,
-                'phase': phase,
-                'phase_class': phase_class,
-                'title': title,
-                'description': description,
-                'date': datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y'),
-                'duration': f'{duration_minutes} мин',
-                'difficulty': difficulty,
-                'difficulty_class': difficulty_class,
-                'status': status,
-                'action_text': action_text,
-                'result_id': result_id,
-                'session_type': session_type,
-                'started_at': started_at,
-                'completed_at': completed_at
-            })
+        sessions = [_row_to_session(row) for row in existing_sessions]
         
-        conn.close()
         return sessions
     
     # Если сессий нет, создаем их на основе файлов пользователя
@@ -324,18 +295,18 @@ def get_or_create_user_study_sessions(user_id):
     
     user_files = c.fetchall()
     
-    # Получаем статистику пользователя для определения статуса сессий
-    c.execute('SELECT COUNT(*) FROM result WHERE user_id = ?', (user_id,))
-    total_results = c.fetchone()[0]
+    # Статистика пользователя для определения статуса сессий, если ее не передали
+    if total_results is None:
+        c.execute('SELECT COUNT(*) FROM result WHERE user_id = ?', (user_id,))
+        total_results = c.fetchone()[0]
     
-    c.execute('''
-        SELECT COUNT(*) FROM user_progress 
-        WHERE user_id = ? AND consecutive_correct >= 3
-    ''', (user_id,))
-    mastered_cards = c.fetchone()[0]
-    
-    c.execute('SELECT COUNT(*) FROM user_progress WHERE user_id = ?', (user_id,))
-    total_cards_studied = c.fetchone()[0]
+    if mastered_cards is None or total_cards_studied is None:
+        c.execute('''
+            SELECT COUNT(*), COALESCE(SUM(consecutive_correct >= 3), 0)
+            FROM user_progress
+            WHERE user_id = ?
+        ''', (user_id,))
+        total_cards_studied, mastered_cards = c.fetchone()
     
     sessions = []
     
@@ -366,6 +337,8 @@ def get_or_create_user_study_sessions(user_id):
             'session_type': 'onboarding'
         })
     else:
+        new_rows = []
+        
         # Создаем сессии на основе реальных файлов пользователя
         for i, (result_id, filename, file_type, created_at) in enumerate(user_files[:3], 1):
             # Определяем фазу на основе порядка
@@ -377,28 +350,20 @@ def get_or_create_user_study_sessions(user_id):
                 phase = 'МАСТЕРСТВО'
             
             # Создаем персональную сессию на основе файла
-            file_name_short = filename[:30] + '...' if len(filename) > 30 else filename
-            title = f'Сессия {i}: Изучение "{file_name_short}"'
+            title = f'Сессия {i}: Изучение "{_short_name(filename)}"'
             description = f'Работа с материалом из файла {file_type.upper()}'
             difficulty = 'средний' if i <= 2 else 'сложный'
             status = 'completed' if mastered_cards > i * 2 else 'available'
             
-            # Сохраняем сессию в базу данных
-            c.execute('''
-                INSERT INTO study_sessions 
-                (user_id, result_id, session_type, title, description, phase, difficulty, duration_minutes, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, result_id, 'study', title, description, phase, difficulty, 45, status))
-            
-            session_id = c.lastrowid
+            new_rows.append((user_id, result_id, 'study', title, description, phase, difficulty, 45, status))
             
             sessions.append({
-                'id': session_id,
+                'id': None,
                 'phase': phase,
                 'phase_class': f'phase-{phase.lower()}',
                 'title': title,
                 'description': description,
-                'date': datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y'),
+                'date': format_db_date(created_at),
                 'duration': '45 мин',
                 'difficulty': difficulty,
                 'difficulty_class': f'difficulty-{difficulty}',
@@ -412,18 +377,12 @@ def get_or_create_user_study_sessions(user_id):
         
         # Добавляем сессию повторения, если есть карточки для повторения
         if total_cards_studied > 0:
-            c.execute('''
-                INSERT INTO study_sessions 
-                (user_id, session_type, title, description, phase, difficulty, duration_minutes, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, 'review', 'Сессия повторения', 
-                  f'Повторение {total_cards_studied} изученных карточек', 
-                  'ПОВТОРЕНИЕ', 'легкий', 30, 'available'))
-            
-            session_id = c.lastrowid
+            new_rows.append((user_id, None, 'review', 'Сессия повторения', 
+                             f'Повторение {total_cards_studied} изученных карточек', 
+                             'ПОВТОРЕНИЕ', 'легкий', 30, 'available'))
             
             sessions.append({
-                'id': session_id,
+                'id': None,
                 'phase': 'ПОВТОРЕНИЕ',
                 'phase_class': 'phase-повторение',
                 'title': 'Сессия повторения',
@@ -437,23 +396,52 @@ def get_or_create_user_study_sessions(user_id):
                 'cards_count': total_cards_studied,
                 'session_type': 'review'
             })
+        
+        # Сохраняем все сессии одним executemany; rowid внутри транзакции идут подряд
+        c.executemany('''
+            INSERT INTO study_sessions 
+            (user_id, result_id, session_type, title, description, phase, difficulty, duration_minutes, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', new_rows)
+        first_id = c.execute('SELECT last_insert_rowid()').fetchone()[0] - len(new_rows) + 1
+        for session_id, session_data in enumerate(sessions, first_id):
+            session_data['id'] = session_id
     
     conn.commit()
-    conn.close()
     
     return sessions
 import logging
 from pathlib import Path
-import yt_dlp
 import tempfile
 import re
 import secrets
+import uuid
+
+class UploadRequest(Request):
+    """Запрос, который пишет загружаемые файлы сразу в папку загрузок крупными блоками"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile('wb+', buffering=1 << 20, dir=app.config['UPLOAD_FOLDER'],
+                                           prefix='.upload_', suffix='.part')
+
+def save_uploaded_file(file, filepath):
+    """Сохранение загруженного файла: жесткая ссылка на временный файл без повторного копирования"""
+    try:
+        file.stream.flush()
+        os.link(file.stream.name, filepath)
+    except (AttributeError, TypeError, OSError):
+        file.save(filepath, buffer_size=1 << 20)
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.jinja_env.globals['is_admin'] = is_admin
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 200)) * 1024 * 1024
 app.config['UPLOAD_FOLDER'] = 'uploads'
 
+# Соединение с БД берется из пула на время запроса и возвращается в teardown
+db.init_app(app)
+
 # Настройка Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -479,38 +467,100 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def json_response(payload, status=200):
+    """JSON-ответ, сериализованный через orjson (UTF-8 без экранирования)"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
+def export_json_bytes(payload):
+    """Сериализация файла экспорта: компактно, с отступами только при ?pretty=1"""
+    option = orjson.OPT_NON_STR_KEYS
+    if request.args.get('pretty') == '1':
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(payload, option=option)
+
+def to_json_text(value):
+    """Сериализация JSON-колонки через orjson (UTF-8, нестроковые ключи как в json.dumps)"""
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+# Допустимые символы email (формат local@domain.tld, как в клиентской проверке)
+_EMAIL_TLD_CHARS = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_EMAIL_DOMAIN_CHARS = _EMAIL_TLD_CHARS + b'0123456789.-'
+_EMAIL_LOCAL_CHARS = _EMAIL_DOMAIN_CHARS + b'_%+'
+
+def is_valid_email(email):
+    """Проверка формата email без регулярного выражения"""
+    if not email or len(email) > 254 or not email.isascii():
+        return False
+    local, _, domain = email.encode('ascii').partition(b'@')
+    dot = domain.rfind(b'.')
+    if not local or dot < 1 or len(domain) - dot < 3:
+        return False
+    # bytes.translate с delete оставляет только недопустимые символы
+    return not (local.translate(None, _EMAIL_LOCAL_CHARS)
+                or domain[:dot].translate(None, _EMAIL_DOMAIN_CHARS)
+                or domain[dot + 1:].translate(None, _EMAIL_TLD_CHARS))
+
 # Допустимые форматы файла
-ALLOWED_EXTENSIONS = {'pdf', 'pptx', 'mp4', 'mov', 'mkv'}
+ALLOWED_EXTENSIONS = frozenset({'.pdf', '.pptx', '.mp4', '.mov', '.mkv'})
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    # Срез по последней точке без списка из rsplit
+    dot = filename.rfind('.')
+    return dot != -1 and filename[dot:].lower() in ALLOWED_EXTENSIONS
+
+# Диапазон страниц вида "1-5,7,10-12"
+_PAGE_RANGE_RE = re.compile(r'\s*\d+\s*(?:-\s*\d+\s*)?(?:,\s*\d+\s*(?:-\s*\d+\s*)?)*')
+
+@lru_cache(maxsize=256)
+def parse_page_range(page_range):
+    """Разбор диапазона страниц в отсортированные непересекающиеся отрезки (start, end).
+    
+    Отрезки, а не список страниц: число страниц считается без раскрытия диапазона.
+    Неверный формат - ValueError.
+    """
+    if not _PAGE_RANGE_RE.fullmatch(page_range):
+        raise ValueError(f"Invalid page range: {page_range}")
+    spans = []
+    for part in page_range.split(','):
+        start, _, end = part.partition('-')
+        start = int(start)
+        end = int(end) if end else start
+        spans.append((min(start, end), max(start, end)))
+    spans.sort()
+    merged = [spans[0]]
+    for start, end in spans[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return tuple(merged)
+
+# Поддерживаемые платформы для загрузки видео (одно выражение вместо цикла по шаблонам)
+_VIDEO_URL_RE = re.compile(
+    r'youtube\.com/watch\?v='
+    r'|youtu\.be/'
+    r'|vimeo\.com/'
+    r'|rutube\.ru/'
+    r'|ok\.ru/'
+    r'|vk\.com/'
+    r'|vk\.ru/'
+    r'|vkvideo\.ru/'
+    r'|dailymotion\.com/'
+    r'|twitch\.tv/'
+    r'|facebook\.com/'
+    r'|instagram\.com/'
+    r'|tiktok\.com/',
+    re.IGNORECASE
+)
 
 def is_valid_video_url(url):
     """Проверка валидности URL для загрузки видео"""
-    # Поддерживаемые платформы
-    supported_patterns = [
-        r'youtube\.com/watch\?v=',
-        r'youtu\.be/',
-        r'vimeo\.com/',
-        r'rutube\.ru/',
-        r'ok\.ru/',
-        r'vk\.com/',
-        r'vk\.ru/',
-        r'vkvideo\.ru/',
-        r'dailymotion\.com/',
-        r'twitch\.tv/',
-        r'facebook\.com/',
-        r'instagram\.com/',
-        r'tiktok\.com/'
-    ]
-    
-    for pattern in supported_patterns:
-        if re.search(pattern, url, re.IGNORECASE):
-            return True
-    return False
+    return _VIDEO_URL_RE.search(url) is not None
 
 def download_video_from_url(url, upload_folder, task_id=None, analysis_manager=None):
     """Загрузка видео по URL с помощью yt-dlp и поддержкой отмены"""
+    # yt-dlp загружает сотни экстракторов, поэтому импортируется только при загрузке видео
+    import yt_dlp
     
     def check_cancellation():
         """Проверка отмены задачи во время загрузки"""
@@ -525,8 +575,15 @@ def download_video_from_url(url, upload_folder, task_id=None, analysis_manager=N
         
         logger.info(f"📁 Output template: {output_template}")
         
-        # Получаем список файлов до загрузки
-        files_before = set(os.listdir(upload_folder)) if os.path.exists(upload_folder) else set()
+        # Пути файлов этой загрузки сообщает сам yt-dlp, папку сканировать не нужно
+        finished_files = []
+        partial_files = set()
+        
+        def progress_hook(d):
+            if d.get('tmpfilename'):
+                partial_files.add(d['tmpfilename'])
+            if d['status'] == 'finished':
+                finished_files.append(d['filename'])
         
         ydl_opts = {
             'format': 'best[height<=720]/best',  # Максимум 720p для экономии места
@@ -544,6 +601,7 @@ def download_video_from_url(url, upload_folder, task_id=None, analysis_manager=N
             'embed_subs': False,
             'writesubtitles': False,
             'writeautomaticsub': False,
+            'progress_hooks': [progress_hook],
         }
         
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
@@ -575,46 +633,23 @@ def download_video_from_url(url, upload_folder, task_id=None, analysis_manager=N
             # Проверяем отмену перед началом загрузки
             check_cancellation()
             
-            # Загружаем видео
+            # Загружаем видео по уже полученной информации, без повторного извлечения по URL
             logger.info("⬇️ Starting download...")
-            ydl.download([url])
+            info = ydl.process_ie_result(info, download=True)
             logger.info("✅ Download completed")
             
             # Проверяем отмену после загрузки
             check_cancellation()
             
-            # Получаем список файлов после загрузки
-            files_after = set(os.listdir(upload_folder)) if os.path.exists(upload_folder) else set()
-            new_files = files_after - files_before
+            filepath = finished_files[-1] if finished_files else ydl.prepare_filename(info)
+            downloaded_file = os.path.basename(filepath)
+            logger.info(f"📁 Downloaded file: {downloaded_file}")
             
-            logger.info(f"📁 New files found: {list(new_files)}")
-            
-            # Ищем видеофайл среди новых файлов
+            # Принимаем только видеофайлы
             video_extensions = ['.mp4', '.mkv', '.webm', '.mov', '.avi', '.flv']
-            downloaded_file = None
-            
-            for file in new_files:
-                file_ext = os.path.splitext(file)[1].lower()
-                if file_ext in video_extensions:
-                    downloaded_file = file
-                    break
-            
-            if not downloaded_file:
-                # Fallback: ищем по timestamp
-                logger.warning("🔍 Fallback: searching by timestamp...")
-                for file in os.listdir(upload_folder):
-                    if file.startswith(timestamp):
-                        file_ext = os.path.splitext(file)[1].lower()
-                        if file_ext in video_extensions:
-                            downloaded_file = file
-                            break
-            
-            if not downloaded_file:
-                logger.error(f"❌ Available files: {list(os.listdir(upload_folder))}")
+            if os.path.splitext(downloaded_file)[1].lower() not in video_extensions:
                 raise Exception("Не удалось найти загруженный видеофайл")
             
-            filepath = os.path.join(upload_folder, downloaded_file)
-            
             # Проверяем, что файл действительно существует и не пустой
             if not os.path.exists(filepath):
                 raise Exception(f"Файл не найден: {filepath}")
@@ -634,22 +669,29 @@ def download_video_from_url(url, upload_folder, task_id=None, analysis_manager=N
         if "cancelled" in str(e).lower():
             logger.info("🗑️ Cleaning up files after cancellation...")
             
-            # Удаляем все новые файлы, которые могли быть загружены
+            # Удаляем файлы, которые yt-dlp успел создать для этой загрузки
             try:
-                files_after = set(os.listdir(upload_folder)) if os.path.exists(upload_folder) else set()
-                new_files = files_after - files_before
-                
-                for file in new_files:
-                    file_path = os.path.join(upload_folder, file)
+                for file_path in partial_files.union(finished_files):
                     if os.path.exists(file_path):
                         os.remove(file_path)
-                        logger.info(f"🗑️ Removed cancelled download: {file}")
+                        logger.info(f"🗑️ Removed cancelled download: {os.path.basename(file_path)}")
                         
             except Exception as cleanup_error:
                 logger.warning(f"⚠️ Error during cleanup: {cleanup_error}")
         
         raise e
 
+def add_missing_columns(c, table, columns):
+    """Добавление колонок, которых нет в таблице; возвращает множество добавленных"""
+    existing = {row[1] for row in c.execute(f'PRAGMA table_info({table})')}
+    added = set()
+    for name, column_type in columns:
+        if name not in existing:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+            logger.info(f"Added {name} column to {table} table")
+            added.add(name)
+    return added
+
 def init_db():
     """Инициализация БД SQLite"""
     # Запускаем миграции перед инициализацией
@@ -661,6 +703,10 @@ def init_db():
     conn = sqlite3.connect('ai_study.db')
     c = conn.cursor()
     
+    # Схема создается одной транзакцией: один commit на запуск, а при ошибке
+    # незафиксированные изменения откатываются вместе с соединением
+    c.execute('BEGIN')
+    
     # Таблица с результатом
     c.execute('''
         CREATE TABLE IF NOT EXISTS result (
@@ -679,73 +725,33 @@ def init_db():
             user_id INTEGER,
             access_token TEXT UNIQUE,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            test_questions_json TEXT,
+            test_questions_status TEXT,
+            test_questions_started_at TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     ''')
     
-    # Добавляем колонку full_text если её нет (миграция)
-    try:
-        c.execute('ALTER TABLE result ADD COLUMN full_text TEXT')
-        logger.info("Added full_text column to result table")
-    except sqlite3.OperationalError:
-        # Колонка уже существует
-        pass
+    # Добавляем недостающие колонки (миграция); access_token добавляется без UNIQUE
+    added_columns = add_missing_columns(c, 'result', (
+        ('full_text', 'TEXT'),
+        ('user_id', 'INTEGER'),
+        ('test_questions_json', 'TEXT'),
+        ('access_token', 'TEXT'),
+    ))
     
-    # Добавляем колонку user_id если её нет (миграция)
-    try:
-        c.execute('ALTER TABLE result ADD COLUMN user_id INTEGER')
-        logger.info("Added user_id column to result table")
-    except sqlite3.OperationalError:
-        # Колонка уже существует
-        pass
+    # Добавляем токены к существующим записям без токенов
+    c.execute('SELECT id FROM result WHERE access_token IS NULL')
+    results_without_tokens = c.fetchall()
+    if results_without_tokens:
+        c.executemany('UPDATE result SET access_token = ? WHERE id = ?',
+                      [(secrets.token_urlsafe(32), result_id) for (result_id,) in results_without_tokens])
+        logger.info(f"Added access tokens to {len(results_without_tokens)} existing results")
     
-    # Добавляем колонку test_questions_json если её нет (миграция)
-    try:
-        c.execute('ALTER TABLE result ADD COLUMN test_questions_json TEXT')
-        logger.info("Added test_questions_json column to result table")
-    except sqlite3.OperationalError:
-        # Колонка уже существует
-        pass
-    
-    # Добавляем колонку access_token если её нет (миграция)
-    try:
-        # Сначала добавляем колонку без UNIQUE ограничения
-        c.execute('ALTER TABLE result ADD COLUMN access_token TEXT')
-        logger.info("Added access_token column to result table")
-        
-        # Добавляем токены к существующим записям без токенов
-        c.execute('SELECT id FROM result WHERE access_token IS NULL')
-        results_without_tokens = c.fetchall()
-        
-        for (result_id,) in results_without_tokens:
-            access_token = secrets.token_urlsafe(32)
-            c.execute('UPDATE result SET access_token = ? WHERE id = ?', (access_token, result_id))
-            logger.info(f"Added access token to existing result {result_id}")
-        
-        # Теперь создаем уникальный индекс
-        try:
-            c.execute('CREATE UNIQUE INDEX idx_result_access_token ON result(access_token)')
-            logger.info("Created unique index for access_token")
-        except sqlite3.OperationalError as e:
-            if "already exists" not in str(e):
-                logger.warning(f"Could not create unique index: {e}")
-        
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            # Колонка уже существует, проверяем есть ли записи без токенов
-            try:
-                c.execute('SELECT id FROM result WHERE access_token IS NULL')
-                results_without_tokens = c.fetchall()
-                
-                for (result_id,) in results_without_tokens:
-                    access_token = secrets.token_urlsafe(32)
-                    c.execute('UPDATE result SET access_token = ? WHERE id = ?', (access_token, result_id))
-                    logger.info(f"Added access token to existing result {result_id}")
-            except sqlite3.OperationalError:
-                # Колонка не существует, что странно, но продолжаем
-                pass
-        else:
-            logger.error(f"Error adding access_token column: {e}")
+    # Уникальный индекс для колонки, добавленной миграцией
+    if 'access_token' in added_columns:
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_result_access_token ON result(access_token)')
+        logger.info("Created unique index for access_token")
     
     # Таблица прогресса пользователя
     c.execute('''
@@ -764,12 +770,15 @@ def init_db():
     ''')
     
     # Добавляем колонку user_id в user_progress если её нет
-    try:
-        c.execute('ALTER TABLE user_progress ADD COLUMN user_id INTEGER')
-        logger.info("Added user_id column to user_progress table")
-    except sqlite3.OperationalError:
-        # Колонка уже существует
-        pass
+    add_missing_columns(c, 'user_progress', (('user_id', 'INTEGER'),))
+    
+    # Уникальный индекс idx_progress_unique для UPSERT создает миграция 010
+    
+    # Покрывающий индекс для выборок прогресса по результату и пользователю
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_progress_cover
+        ON user_progress(result_id, user_id, flashcard_id, consecutive_correct, ease_factor, next_review)
+    ''')
     
     # Таблица для истории чата
     c.execute('''
@@ -786,53 +795,57 @@ def init_db():
     ''')
     
     # Добавляем колонку user_id в chat_history если её нет
-    try:
-        c.execute('ALTER TABLE chat_history ADD COLUMN user_id INTEGER')
-        logger.info("Added user_id column to chat_history table")
-    except sqlite3.OperationalError:
-        # Колонка уже существует
-        pass
+    add_missing_columns(c, 'chat_history', (('user_id', 'INTEGER'),))
     
-    # Инициализируем таблицы аутентификации
-    init_auth_db()
+    # Индексы под выборку истории чата и списки результатов пользователя
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chat_result_time ON chat_history(result_id, created_at)')
+    # Покрывающий индекс списков результатов: страница читается без строк таблицы,
+    # где access_token может лежать после многомегабайтного full_text
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_result_user
+        ON result(user_id, created_at, filename, file_type, access_token)
+    ''')
     
+    # Индексы под статистику дашборда и учебные сессии пользователя
+    c.execute('CREATE INDEX IF NOT EXISTS idx_result_user_type ON result(user_id, file_type)')
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_progress_user_review
+        ON user_progress(user_id, consecutive_correct, next_review)
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_user_created ON study_sessions(user_id, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sessions_result ON study_sessions(result_id)')
+    
+    conn.commit()
+    
+    # Статистика планировщика: полный ANALYZE один раз, дальше только PRAGMA optimize
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+    if c.fetchone():
+        c.execute('PRAGMA optimize')
+    else:
+        c.execute('ANALYZE')
     conn.commit()
     conn.close()
+    
+    # Инициализируем таблицы аутентификации (отдельное соединение, после commit)
+    init_auth_db()
+
+# Необязательные JSON-поля результата анализа и их значения по умолчанию
+_OPTIONAL_RESULT_JSON = (('mind_map', {}), ('study_plan', {}), ('quality_assessment', {}),
+                         ('video_segments', []), ('key_moments', []))
 
 def save_result(filename, file_type, analysis_result, page_info=None, user_id=None, task_id=None, analysis_manager=None):
     """Сохранение результата в БД"""
-    conn = sqlite3.connect('ai_study.db')
-    c = conn.cursor()
-    
     # Добавляем информацию о страницах в результат
     if page_info:
         analysis_result['page_info'] = page_info
     
-    # Сериализовываем данные
-    topics_json = json.dumps(analysis_result['topics_data'], ensure_ascii=False)
-    flashcards_json = json.dumps(analysis_result['flashcards'], ensure_ascii=False)
-    mind_map_json = json.dumps(analysis_result.get('mind_map', {}), ensure_ascii=False)
-    study_plan_json = json.dumps(analysis_result.get('study_plan', {}), ensure_ascii=False)
-    quality_json = json.dumps(analysis_result.get('quality_assessment', {}), ensure_ascii=False)
-    video_segments_json = json.dumps(analysis_result.get('video_segments', []), ensure_ascii=False)
-    key_moments_json = json.dumps(analysis_result.get('key_moments', []), ensure_ascii=False)
+    # Сериализовываем JSON-колонки в порядке INSERT (темы и карточки обязательны)
+    json_columns = [to_json_text(analysis_result[key]) for key in ('topics_data', 'flashcards')]
+    json_columns += [to_json_text(analysis_result.get(key, default)) for key, default in _OPTIONAL_RESULT_JSON]
     
     # Получаем полный текст для чата
     full_text = analysis_result.get('full_text', '')
     
-    # Генерируем тестовые вопросы с обновлением прогресса
-    if analysis_manager and task_id:
-        analysis_manager.update_task_progress(task_id, 99, "Генерация тестовых вопросов")
-    
-    logger.info("Генерируем тестовые вопросы...")
-    test_questions = generate_test_questions({
-        'full_text': full_text,
-        'summary': analysis_result['summary'],
-        'topics_data': analysis_result['topics_data']
-    })
-    test_questions_json = json.dumps(test_questions, ensure_ascii=False)
-    logger.info(f"Сгенерировано {len(test_questions)} тестовых вопросов")
-    
     # Завершаем прогресс
     if analysis_manager and task_id:
         analysis_manager.update_task_progress(task_id, 100, "Готово")
@@ -844,117 +857,181 @@ def save_result(filename, file_type, analysis_result, page_info=None, user_id=No
     # Генерируем уникальный токен доступа
     access_token = secrets.token_urlsafe(32)
     
-    c.execute('''
-        INSERT INTO result (
-            filename, file_type, topics_json, summary, flashcards_json,
-            mind_map_json, study_plan_json, quality_json,
-            video_segments_json, key_moments_json, full_text, user_id, test_questions_json, access_token
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        filename, file_type, topics_json, analysis_result['summary'], 
-        flashcards_json, mind_map_json, study_plan_json, quality_json,
-        video_segments_json, key_moments_json, full_text, user_id, test_questions_json, access_token
-    ))
+    # BEGIN IMMEDIATE сразу берет блокировку записи и у воркеров других процессов.
+    # Тестовые вопросы пока не заданы (NULL), их дописывает фоновая генерация
+    with get_conn(write=True) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        result_id = conn.execute('''
+            INSERT INTO result (
+                filename, file_type, summary, topics_json, flashcards_json,
+                mind_map_json, study_plan_json, quality_json,
+                video_segments_json, key_moments_json, full_text, user_id, access_token
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            filename, file_type, analysis_result['summary'], *json_columns,
+            full_text, user_id, access_token
+        )).lastrowid
+        conn.commit()
     
-    result_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    # Запрос GPT за тестовыми вопросами идет в фоне и не задерживает ответ с результатом;
+    # пока вопросов нет, страница теста показывает состояние генерации
+    start_test_questions_generation(result_id, {
+        'full_text': full_text,
+        'summary': analysis_result['summary'],
+        'topics_data': analysis_result['topics_data']
+    })
     
     return access_token
 
+# Колонки результата под именами ключей словаря; JSON-колонки разбираются отдельно
+_RESULT_COLUMNS = '''
+    filename, file_type, topics_json AS topics_data, summary, flashcards_json AS flashcards,
+    mind_map_json AS mind_map, study_plan_json AS study_plan, quality_json AS quality_assessment,
+    video_segments_json AS video_segments, key_moments_json AS key_moments,
+    COALESCE(full_text, '') AS full_text, created_at, user_id, test_questions_json AS test_questions
+'''
+_RESULT_JSON_FIELDS = ('topics_data', 'flashcards', 'mind_map', 'study_plan',
+                       'quality_assessment', 'video_segments', 'key_moments')
+
+# Токен доступа результата не меняется, поэтому кэшируется только его id;
+# сами данные берутся из кэша get_result, который сбрасывается при изменениях
+_token_id_cache = TTLCache(maxsize=1024, ttl=300)
+_token_id_cache_lock = threading.Lock()
+
 def get_result_by_token(access_token):
     """Получение результата по токену доступа"""
-    conn = sqlite3.connect('ai_study.db')
-    c = conn.cursor()
+    with _token_id_cache_lock:
+        result_id = _token_id_cache.get(access_token)
+    
+    if result_id is None:
+        row = get_db().execute('SELECT id FROM result WHERE access_token = ?', (access_token,)).fetchone()
+        if row is None:
+            return None
+        result_id = row[0]
+        with _token_id_cache_lock:
+            _token_id_cache[access_token] = result_id
+    
+    result_data = get_result(result_id, check_access=False)
+    if result_data is None:
+        return None  # Результат удален
+    
+    # Проверяем права доступа - если у результата есть владелец, доступ только у него
+    if result_data['user_id']:
+        # Результат принадлежит конкретному пользователю
+        if not (current_user and current_user.is_authenticated and result_data['user_id'] == current_user.id):
+            return None  # Нет доступа к чужому результату
+    
+    # Токен передается в шаблон отдельно, в данных результата нужен id
+    del result_data['access_token']
+    result_data['id'] = result_id
+    return result_data
+
+class LazyJSONRow(MutableMapping):
+    """Строка результата, JSON-колонки которой разбираются при первом обращении к ключу.
+    
+    Не наследует dict: dict(row), {**row} и render_template(**row) обходят строку через keys()
+    и получают все колонки, а не только уже разобранные. Копия разбирает JSON заново,
+    поэтому изменение вложенных списков и словарей не затрагивает закэшированную строку
+    """
+    
+    def __init__(self, data, raw_json):
+        self._data = data
+        self._raw_json = raw_json  # еще не разобранные колонки
+    
+    def __getitem__(self, key):
+        try:
+            return self._data[key]
+        except KeyError:
+            pass
+        value = self._data[key] = orjson.loads(self._raw_json.pop(key))
+        return value
     
-    c.execute('''
-        SELECT id, filename, file_type, topics_json, summary, flashcards_json,
-               mind_map_json, study_plan_json, quality_json,
-               video_segments_json, key_moments_json, full_text, created_at, user_id, test_questions_json
-        FROM result WHERE access_token = ?
-    ''', (access_token,))
+    def __setitem__(self, key, value):
+        self._raw_json.pop(key, None)
+        self._data[key] = value
     
-    row = c.fetchone()
-    conn.close()
+    def __delitem__(self, key):
+        if key in self._raw_json:
+            del self._raw_json[key]
+        else:
+            del self._data[key]
     
-    if row:
-        result_data = {
-            'id': row[0],
-            'filename': row[1],
-            'file_type': row[2],
-            'topics_data': json.loads(row[3]),
-            'summary': row[4],
-            'flashcards': json.loads(row[5]),
-            'mind_map': json.loads(row[6]),
-            'study_plan': json.loads(row[7]),
-            'quality_assessment': json.loads(row[8]),
-            'video_segments': json.loads(row[9]),
-            'key_moments': json.loads(row[10]),
-            'full_text': row[11] or '',
-            'created_at': row[12],
-            'user_id': row[13],
-            'test_questions': json.loads(row[14]) if row[14] else []
-        }
-        
-        # Проверяем права доступа - если у результата есть владелец, доступ только у него
-        if result_data['user_id']:
-            # Результат принадлежит конкретному пользователю
-            if not (current_user and current_user.is_authenticated and result_data['user_id'] == current_user.id):
-                return None  # Нет доступа к чужому результату
-        
-        # Извлекаем информацию о страницах из mind_map (если она там сохранена)
-        mind_map_data = result_data['mind_map']
-        if isinstance(mind_map_data, dict) and 'page_info' in mind_map_data:
-            result_data['page_info'] = mind_map_data['page_info']
-        
-        return result_data
-    return None
+    def __contains__(self, key):
+        return key in self._data or key in self._raw_json
+    
+    def __iter__(self):
+        return itertools.chain(self._data, self._raw_json)
+    
+    def __len__(self):
+        return len(self._data) + len(self._raw_json)
+    
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self)!r})'
+    
+    def copy(self):
+        return LazyJSONRow(copy.deepcopy(self._data), dict(self._raw_json))
+
+# Кэш разобранных результатов по id; доступ проверяется при каждом обращении.
+# Наружу отдаются только копии (get_result), сама закэшированная строка JSON не разбирает.
+_result_cache = TTLCache(maxsize=512, ttl=300)
+_result_cache_lock = threading.RLock()
+
+def invalidate_result(result_id):
+    """Сброс закэшированного результата после изменения или удаления"""
+    with _result_cache_lock:
+        _result_cache.pop(int(result_id), None)
 
 def get_result(result_id, check_access=True):
     """Получение результата из базы данных по ID (для обратной совместимости)"""
-    conn = sqlite3.connect('ai_study.db')
-    c = conn.cursor()
-    
-    c.execute('''
-        SELECT filename, file_type, topics_json, summary, flashcards_json,
-               mind_map_json, study_plan_json, quality_json,
-               video_segments_json, key_moments_json, full_text, created_at, user_id, test_questions_json, access_token
-        FROM result WHERE id = ?
-    ''', (result_id,))
-    
-    row = c.fetchone()
-    conn.close()
+    try:
+        result_id = int(result_id)
+    except (TypeError, ValueError):
+        return None
+    
+    with _result_cache_lock:
+        result_data = _result_cache.get(result_id)
+    
+    if result_data is None:
+        result_data = _load_result(result_id)
+        if result_data is None:
+            return None
+        with _result_cache_lock:
+            _result_cache[result_id] = result_data
+    
+    # Проверяем права доступа
+    if check_access and current_user.is_authenticated:
+        result_user_id = result_data['user_id']
+        if result_user_id and result_user_id != current_user.id:
+            return None  # Нет доступа к чужому результату
+    
+    return result_data.copy()
+
+def _load_result(result_id):
+    """Чтение и разбор строки результата из БД"""
+    # Вызывается и из фоновых потоков, поэтому соединение берется из пула, а не из запроса
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        row = c.execute(f'''
+            SELECT {_RESULT_COLUMNS}, access_token, mind_map_json -> '$.page_info' AS page_info
+            FROM result WHERE id = ?
+        ''', (result_id,)).fetchone()
     
     if row:
-        # Проверяем права доступа
-        if check_access and current_user.is_authenticated:
-            result_user_id = row[12]  # user_id из результата
-            if result_user_id and result_user_id != current_user.id:
-                return None  # Нет доступа к чужому результату
-        
-        result_data = {
-            'filename': row[0],
-            'file_type': row[1],
-            'topics_data': json.loads(row[2]),
-            'summary': row[3],
-            'flashcards': json.loads(row[4]),
-            'mind_map': json.loads(row[5]),
-            'study_plan': json.loads(row[6]),
-            'quality_assessment': json.loads(row[7]),
-            'video_segments': json.loads(row[8]),
-            'key_moments': json.loads(row[9]),
-            'full_text': row[10] or '',
-            'created_at': row[11],
-            'user_id': row[12],
-            'test_questions': json.loads(row[13]) if row[13] else [],
-            'access_token': row[14]
-        }
+        result_data = dict(row)
+        # JSON-колонки разбираются только при обращении: чату и истории нужны лишь текст и имя файла
+        raw_json = {key: result_data.pop(key) for key in _RESULT_JSON_FIELDS}
+        if result_data['test_questions']:
+            raw_json['test_questions'] = result_data.pop('test_questions')
+        else:
+            result_data['test_questions'] = []
         
-        # Извлекаем информацию о страницах из mind_map (если она там сохранена)
-        mind_map_data = result_data['mind_map']
-        if isinstance(mind_map_data, dict) and 'page_info' in mind_map_data:
-            result_data['page_info'] = mind_map_data['page_info']
+        # Информация о страницах из mind_map извлекается в SQLite (JSON1), сам mind_map не разбирается
+        page_info = result_data.pop('page_info')
+        result_data = LazyJSONRow(result_data, raw_json)
+        if page_info is not None:
+            result_data['page_info'] = orjson.loads(page_info)
         
         return result_data
     return None
@@ -981,12 +1058,9 @@ def login():
                 login_user(user, remember=remember)
                 
                 # Обновляем время последнего входа
-                conn = sqlite3.connect('ai_study.db')
-                c = conn.cursor()
-                c.execute('UPDATE users SET last_login = ? WHERE id = ?', 
-                         (datetime.now(), user.id))
-                conn.commit()
-                conn.close()
+                with get_conn(write=True) as conn:
+                    conn.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (user.id,))
+                    conn.commit()
                 
                 logger.info(f"User logged in: {email}")
                 
@@ -1028,11 +1102,8 @@ def register():
             errors.append('Подтверждение пароля обязательно')
         
         # Валидация email
-        if email:
-            import re
-            email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-            if not re.match(email_pattern, email):
-                errors.append('Неверный формат email адреса')
+        if email and not is_valid_email(email):
+            errors.append('Неверный формат email адреса')
         
         # Валидация имени пользователя
         if username:
@@ -1067,6 +1138,7 @@ def register():
         # Создаем пользователя
         try:
             user = User.create(email, username, password)
+            forget_email(email)
             if user:
                 login_user(user)
                 logger.info(f"New user registered and logged in: {email}")
@@ -1097,28 +1169,18 @@ def dashboard():
     per_page = 10
     
     # Получаем статистику пользователя
-    conn = sqlite3.connect('ai_study.db')
-    c = conn.cursor()
+    c = get_db().cursor()
     
-    # Общая статистика
-    c.execute('SELECT COUNT(*) FROM result WHERE user_id = ?', (current_user.id,))
-    total_results = c.fetchone()[0]
-    
-    c.execute('''
-        SELECT COUNT(*) FROM user_progress 
-        WHERE user_id = ? AND consecutive_correct >= 3
-    ''', (current_user.id,))
-    mastered_cards = c.fetchone()[0]
-    
-    c.execute('SELECT COUNT(*) FROM user_progress WHERE user_id = ?', (current_user.id,))
-    total_progress = c.fetchone()[0]
-    
-    # Карточки для повторения сегодня
+    # Общая статистика одним запросом: результаты и один проход по прогрессу карточек
     c.execute('''
-        SELECT COUNT(*) FROM user_progress 
-        WHERE user_id = ? AND date(next_review) <= date('now')
-    ''', (current_user.id,))
-    cards_due_today = c.fetchone()[0]
+        SELECT (SELECT COUNT(*) FROM result WHERE user_id = ?),
+               COUNT(*),
+               COALESCE(SUM(consecutive_correct >= 3), 0),
+               COALESCE(SUM(date(next_review) <= date('now')), 0)
+        FROM user_progress
+        WHERE user_id = ?
+    ''', (current_user.id, current_user.id))
+    total_results, total_progress, mastered_cards, cards_due_today = c.fetchone()
     
     # Все результаты с пагинацией
     offset = (page - 1) * per_page
@@ -1140,8 +1202,6 @@ def dashboard():
             'access_token': row[4]
         })
     
-    conn.close()
-    
     # Простая пагинация
     has_prev = page > 1
     has_next = offset + per_page < total_results
@@ -1195,7 +1255,8 @@ def update_profile():
     new_password = request.form.get('new_password', '')
     new_password_confirm = request.form.get('new_password_confirm', '')
     
-    conn = sqlite3.connect('ai_study.db')
+    # Незафиксированные изменения при выходе с ошибкой откатываются при возврате соединения в пул
+    conn = get_db()
     c = conn.cursor()
     
     # Обновляем имя пользователя
@@ -1208,22 +1269,18 @@ def update_profile():
     if new_password:
         if not current_password:
             flash('Введите текущий пароль', 'danger')
-            conn.close()
             return redirect(url_for('profile'))
         
         if not current_user.check_password(current_password):
             flash('Неверный текущий пароль', 'danger')
-            conn.close()
             return redirect(url_for('profile'))
         
         if new_password != new_password_confirm:
             flash('Новые пароли не совпадают', 'danger')
-            conn.close()
             return redirect(url_for('profile'))
         
         if len(new_password) < 6:
             flash('Новый пароль должен содержать минимум 6 символов', 'danger')
-            conn.close()
             return redirect(url_for('profile'))
         
         new_password_hash = generate_password_hash(new_password)
@@ -1232,10 +1289,34 @@ def update_profile():
         flash('Пароль успешно изменен', 'success')
     
     conn.commit()
-    conn.close()
     
     return redirect(url_for('profile'))
 
+# Типы файлов для фильтров страницы "Мои результаты"
+_MY_RESULTS_FILTERS = {
+    '': (),
+    'pdf': ('.pdf',),
+    'pptx': ('.pptx',),
+    'video': ('.mp4', '.mov', '.mkv'),
+}
+
+def _my_results_queries(file_types):
+    """Текст запросов COUNT и страницы результатов для набора типов файлов"""
+    where = 'WHERE user_id = ?'
+    if file_types:
+        where += f" AND file_type IN ({', '.join('?' * len(file_types))})"
+    list_sql = f'''
+        SELECT id, filename, file_type, created_at, access_token
+        FROM result 
+        {where}
+        ORDER BY created_at DESC
+        LIMIT ? OFFSET ?
+    '''
+    return f'SELECT COUNT(*) FROM result {where}', list_sql, file_types
+
+# Текст SQL постоянный для каждого фильтра и попадает в кэш подготовленных выражений
+_MY_RESULTS_QUERIES = {name: _my_results_queries(file_types) for name, file_types in _MY_RESULTS_FILTERS.items()}
+
 @app.route('/my-results')
 @login_required
 def my_results():
@@ -1244,37 +1325,18 @@ def my_results():
     file_filter = request.args.get('filter', '')
     per_page = 10
     
-    conn = sqlite3.connect('ai_study.db')
-    c = conn.cursor()
+    c = get_db().cursor()
     
-    # Строим SQL запрос с учетом фильтра
-    base_where = 'WHERE user_id = ?'
-    params = [current_user.id]
-    
-    if file_filter:
-        if file_filter == 'pdf':
-            base_where += ' AND file_type = ?'
-            params.append('.pdf')
-        elif file_filter == 'pptx':
-            base_where += ' AND file_type = ?'
-            params.append('.pptx')
-        elif file_filter == 'video':
-            base_where += ' AND file_type IN (?, ?, ?)'
-            params.extend(['.mp4', '.mov', '.mkv'])
+    # Запросы для фильтра берутся готовыми, текст SQL не собирается при каждом запросе
+    count_sql, list_sql, file_types = _MY_RESULTS_QUERIES.get(file_filter, _MY_RESULTS_QUERIES[''])
     
     # Получаем общее количество результатов с учетом фильтра
-    c.execute(f'SELECT COUNT(*) FROM result {base_where}', params)
+    c.execute(count_sql, (current_user.id, *file_types))
     total = c.fetchone()[0]
     
     # Получаем результаты с пагинацией и фильтрацией
     offset = (page - 1) * per_page
-    c.execute(f'''
-        SELECT id, filename, file_type, created_at, access_token
-        FROM result 
-        {base_where}
-        ORDER BY created_at DESC
-        LIMIT ? OFFSET ?
-    ''', params + [per_page, offset])
+    c.execute(list_sql, (current_user.id, *file_types, per_page, offset))
     
     results = []
     for row in c.fetchall():
@@ -1286,8 +1348,6 @@ def my_results():
             'access_token': row[4]
         })
     
-    conn.close()
-    
     # Простая пагинация
     has_prev = page > 1
     has_next = offset + per_page < total
@@ -1306,10 +1366,20 @@ def my_results():
     
     return render_template('my_results.html', results=results, pagination=pagination)
 
+# Шаблоны извлечения вопросов из поврежденного JSON
+_QUESTION_BLOCK_RE = re.compile(
+    r'\{[^}]*?"id":\s*(\d+)[^}]*?"question":\s*"([^"]+)"[^}]*?"options":\s*\{([^}]+)\}[^}]*?"correct_answer":\s*"([^"]+)"[^}]*?"explanation":\s*"([^"]+)"[^}]*?\}',
+    re.DOTALL
+)
+_OPTION_RE = re.compile(r'"([A-D])":\s*"([^"]+)"')
+_OPTION_CLEAN_RE = re.compile(r'[\\n\\r\\t]')
+_QUESTION_TEXT_RE = re.compile(r'"question":\s*"([^"]+)"')
+_CORRECT_ANSWER_RE = re.compile(r'"correct_answer":\s*"([A-D])"')
+_EXPLANATION_RE = re.compile(r'"explanation":\s*"([^"]+)"')
+_OPTIONS_BLOCK_RE = re.compile(r'"options":\s*\{([^}]+)\}')
+
 def extract_questions_from_broken_json(json_text):
     """Извлекает вопросы из поврежденного JSON с помощью регулярных выражений"""
-    import re
-    
     logger.info("Пытаемся извлечь вопросы из поврежденного JSON...")
     
     questions = []
@@ -1317,21 +1387,16 @@ def extract_questions_from_broken_json(json_text):
     try:
         # Улучшенный паттерн для поиска вопросов
         # Ищем блоки, которые содержат все необходимые поля
-        question_blocks = re.findall(
-            r'\{[^}]*?"id":\s*(\d+)[^}]*?"question":\s*"([^"]+)"[^}]*?"options":\s*\{([^}]+)\}[^}]*?"correct_answer":\s*"([^"]+)"[^}]*?"explanation":\s*"([^"]+)"[^}]*?\}',
-            json_text,
-            re.DOTALL
-        )
+        question_blocks = _QUESTION_BLOCK_RE.findall(json_text)
         
         for i, (question_id, question_text, options_str, correct_answer, explanation) in enumerate(question_blocks[:10]):
             # Парсим опции
             options = {}
-            option_pattern = r'"([A-D])":\s*"([^"]+)"'
-            option_matches = re.findall(option_pattern, options_str)
+            option_matches = _OPTION_RE.findall(options_str)
             
             for opt_key, opt_value in option_matches:
                 # Очищаем значение опции от лишних символов
-                clean_value = re.sub(r'[\\n\\r\\t]', ' ', opt_value).strip()
+                clean_value = _OPTION_CLEAN_RE.sub(' ', opt_value).strip()
                 options[opt_key] = clean_value
             
             # Проверяем, что у нас есть все 4 опции
@@ -1351,19 +1416,19 @@ def extract_questions_from_broken_json(json_text):
             logger.info("Пробуем альтернативный метод извлечения...")
             
             # Ищем отдельные компоненты
-            question_texts = re.findall(r'"question":\s*"([^"]+)"', json_text)
-            correct_answers = re.findall(r'"correct_answer":\s*"([A-D])"', json_text)
-            explanations = re.findall(r'"explanation":\s*"([^"]+)"', json_text)
+            question_texts = _QUESTION_TEXT_RE.findall(json_text)
+            correct_answers = _CORRECT_ANSWER_RE.findall(json_text)
+            explanations = _EXPLANATION_RE.findall(json_text)
             
             # Ищем блоки опций
-            options_blocks = re.findall(r'"options":\s*\{([^}]+)\}', json_text)
+            options_blocks = _OPTIONS_BLOCK_RE.findall(json_text)
             
             min_length = min(len(question_texts), len(correct_answers), len(explanations), len(options_blocks))
             
             for i in range(min(min_length, 5)):  # Максимум 5 вопросов
                 # Парсим опции для этого вопроса
                 options = {}
-                option_matches = re.findall(r'"([A-D])":\s*"([^"]+)"', options_blocks[i])
+                option_matches = _OPTION_RE.findall(options_blocks[i])
                 
                 for opt_key, opt_value in option_matches:
                     options[opt_key] = opt_value.strip()
@@ -1386,94 +1451,104 @@ def extract_questions_from_broken_json(json_text):
         logger.error(f"Ошибка при извлечении вопросов: {e}")
         return []
 
-def fix_json_syntax(json_text):
-    """Улучшенное исправление синтаксических ошибок JSON"""
-    import re
-    
-    logger.info("Пытаемся исправить JSON синтаксис...")
-    
-    # Сохраняем оригинал для отладки
-    original_length = len(json_text)
-    
-    # 1. Исправляем отсутствующие запятые между объектами в массиве
-    json_text = re.sub(r'}\s*\n\s*{', '},\n{', json_text)
-    
-    # 2. Исправляем отсутствующие запятые после строковых значений
-    json_text = re.sub(r'"\s*\n\s*"([a-zA-Z_]+)":', '",\n"\\1":', json_text)
-    
-    # 3. Исправляем отсутствующие запятые после чисел
-    json_text = re.sub(r'(\d)\s*\n\s*"([a-zA-Z_]+)":', r'\1,\n"\2":', json_text)
-    
-    # 4. Исправляем отсутствующие запятые после закрывающих скобок объектов
-    json_text = re.sub(r'}\s*\n\s*"([a-zA-Z_]+)":', r'},\n"\1":', json_text)
-    
-    # 5. Исправляем отсутствующие запятые после закрывающих скобок массивов
-    json_text = re.sub(r']\s*\n\s*"([a-zA-Z_]+)":', r'],\n"\1":', json_text)
-    
-    # 6. Убираем лишние запятые перед закрывающими скобками
-    json_text = re.sub(r',\s*}', '}', json_text)
-    json_text = re.sub(r',\s*]', ']', json_text)
-    
-    # 7. Исправляем неэкранированные кавычки в строках
-    # Ищем строки с неэкранированными кавычками и экранируем их
-    def fix_quotes_in_strings(match):
-        content = match.group(1)
-        # Экранируем кавычки внутри строки, но не те что уже экранированы
-        fixed_content = re.sub(r'(?<!\\)"', '\\"', content)
-        return f'"{fixed_content}"'
-    
-    # Применяем исправление кавычек к значениям строк
-    json_text = re.sub(r'"([^"]*(?:\\.[^"]*)*)"(?=\s*[,}:\]])', fix_quotes_in_strings, json_text)
-    
-    # 8. Убираем возможные дублирующиеся запятые
-    json_text = re.sub(r',+', ',', json_text)
+_json_decoder = json.JSONDecoder()
+
+# Общий клиент OpenAI из ml (таймаут, повторы, проверка ключа); ml импортируется при первом запросе
+_openai_client_fn = None
+
+def get_openai_client():
+    """Получение общего клиента OpenAI (ml.get_openai_client)"""
+    global _openai_client_fn
+    if _openai_client_fn is None:
+        from ml import get_openai_client as _openai_client_fn
+    return _openai_client_fn()
+
+# Шаблон контекста материала для генерации тестовых вопросов
+_TEST_CONTEXT_TEMPLATE = (
+    "МАТЕРИАЛ: {filename}\n"
+    "\n"
+    "РЕЗЮМЕ: {summary}...\n"
+    "\n"
+    "ОСНОВНЫЕ ТЕМЫ: {topics}\n"
+    "\n"
+    "ТЕКСТ: {text_sample}\n"
+)
+
+def _read_question_stream(stream):
+    """Читает потоковый ответ GPT и разбирает вопросы по мере их завершения.
     
-    # 9. Исправляем пробелы вокруг двоеточий и запятых
-    json_text = re.sub(r'\s*:\s*', ': ', json_text)
-    json_text = re.sub(r'\s*,\s*', ', ', json_text)
+    Возвращает полный текст ответа и список полностью полученных вопросов.
+    """
+    buf = ''
+    pos = -1  # позиция разбора внутри массива questions
+    questions = []
     
-    logger.info(f"JSON исправлен: {original_length} → {len(json_text)} символов")
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        buf += delta
+        
+        if pos < 0:
+            key = buf.find('"questions"')
+            start = buf.find('[', key) if key >= 0 else -1
+            if start < 0:
+                continue
+            pos = start + 1
+        
+        # Новый объект мог завершиться только вместе с закрывающей скобкой
+        if '}' not in delta:
+            continue
+        
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf) or buf[pos] != '{':
+                break
+            try:
+                question, pos = _json_decoder.raw_decode(buf, pos)
+            except ValueError:
+                break  # объект еще не пришел целиком
+            questions.append(question)
     
-    return json_text
+    return buf, questions
 
 def generate_test_questions(result_data):
     """Генерирует тестовые вопросы с вариантами ответов на основе материала"""
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+        client = get_openai_client()
         
         # Получаем текст материала
-        full_text = result_data.get('full_text', '')
-        summary = result_data.get('summary', '')
-        topics_data = result_data.get('topics_data', {})
+        full_text = result_data.get('full_text') or ''
+        summary = result_data.get('summary') or ''
+        topics_data = result_data.get('topics_data') or {}
         
         # Оптимизируем размер контекста - берем только самое важное
-        text_sample = full_text[:2000] if len(full_text) > 2000 else full_text
+        text_sample = full_text[:2000]
         
-        # Извлекаем только основные темы (без подтем для упрощения)
+        # Названия основных тем и до трех подтем (максимум 5 тем)
         main_topics = []
-        if isinstance(topics_data, dict):
-            for topic, details in list(topics_data.items())[:5]:  # Максимум 5 тем
-                main_topics.append(str(topic))
+        for topic in topics_data.get('main_topics', [])[:5]:
+            subtopics = topic.get('subtopics', [])[:3]
+            title = topic.get('title', 'Тема')
+            main_topics.append(f"{title} ({', '.join(subtopics)})" if subtopics else title)
         
         # Упрощенный контекст
-        context = f"""
-        МАТЕРИАЛ: {result_data.get('filename', 'Учебный материал')}
-        
-        РЕЗЮМЕ: {summary[:500]}...
-        
-        ОСНОВНЫЕ ТЕМЫ: {', '.join(main_topics) if main_topics else 'Не определены'}
-        
-        ТЕКСТ: {text_sample}
-        """
+        context = _TEST_CONTEXT_TEMPLATE.format_map({
+            'filename': result_data.get('filename', 'Учебный материал'),
+            'summary': summary[:500],
+            'topics': ', '.join(main_topics) or 'Не определены',
+            'text_sample': text_sample
+        })
         
-        # Упрощенный промпт - генерируем только 10 вопросов за раз
+        # Упрощенный промпт - генерируем только 10 вопросов за раз.
+        # Неизменные инструкции идут первыми, материал - в конце: общий префикс
+        # запросов совпадает байт в байт и может браться из кэша промптов API
         prompt = f"""
         Создай 10 тестовых вопросов по материалу.
         
-        Материал:
-        {context}
-        
         Требования:
         - 4 легких вопроса (факты из материала)
         - 4 средних вопроса (понимание концепций)
@@ -1496,9 +1571,12 @@ def generate_test_questions(result_data):
                 }}
             ]
         }}
+        
+        Материал:
+        {context}
         """
         
-        # Используем более быстрые настройки
+        # Используем более быстрые настройки, ответ читаем потоком
         response = client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
@@ -1507,171 +1585,243 @@ def generate_test_questions(result_data):
             ],
             temperature=0.1,  # Низкая температура для стабильности
             max_tokens=2000,  # Меньше токенов = быстрее
-            timeout=30  # Таймаут 30 секунд
+            timeout=30,  # Таймаут 30 секунд
+            response_format={"type": "json_object"},  # Синтаксически корректный JSON
+            stream=True
         )
         
-        # Парсим ответ
-        response_text = response.choices[0].message.content
+        # Парсим ответ по мере поступления
+        response_text, streamed_questions = _read_question_stream(response)
         logger.info(f"Получен ответ от GPT длиной {len(response_text)} символов")
         
-        # Извлекаем JSON из ответа
-        import re
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if json_match:
-            json_text = json_match.group()
+        # Извлекаем JSON из ответа: от первой открывающей до последней закрывающей скобки
+        start = response_text.find('{')
+        end = response_text.rfind('}')
+        if start >= 0 and end > start:
+            json_text = response_text[start:end + 1]
             logger.info(f"Извлечен JSON длиной {len(json_text)} символов")
             
             try:
-                questions_data = json.loads(json_text)
+                questions_data = orjson.loads(json_text)
                 questions = questions_data.get('questions', [])
                 logger.info(f"JSON успешно распарсен, найдено {len(questions)} вопросов")
                 return questions
-            except json.JSONDecodeError as e:
+            except orjson.JSONDecodeError as e:
                 logger.error(f"Ошибка парсинга JSON: {e}")
-                logger.info("Пытаемся исправить JSON...")
-                
-                # Улучшенное исправление JSON
-                try:
-                    fixed_json = fix_json_syntax(json_text)
-                    questions_data = json.loads(fixed_json)
-                    questions = questions_data.get('questions', [])
-                    logger.info(f"JSON успешно исправлен, найдено {len(questions)} вопросов")
-                    return questions
-                except json.JSONDecodeError as e2:
-                    logger.error(f"Не удалось исправить JSON: {e2}")
-                    # Попробуем извлечь отдельные вопросы с улучшенным парсингом
-                    questions = extract_questions_from_broken_json(json_text)
-                    if questions:
-                        logger.info(f"Извлечено {len(questions)} вопросов из поврежденного JSON")
-                        return questions
-                    
-                    logger.error("Используем демонстрационные вопросы")
-                    return get_demo_questions()
+            
+            # В JSON-режиме сломанным бывает только ответ, обрезанный по max_tokens:
+            # используем вопросы, полностью пришедшие до места обрыва
+            if streamed_questions:
+                logger.info(f"Используем {len(streamed_questions)} вопросов, разобранных из потока")
+                return streamed_questions
+            
+            logger.info("Пытаемся исправить JSON...")
+            # Толерантный разбор: пропущенные/лишние запятые, кавычки, обрезанный хвост
+            questions_data = json_repair.loads(json_text)
+            if isinstance(questions_data, dict) and questions_data.get('questions'):
+                questions = questions_data['questions']
+                logger.info(f"JSON успешно исправлен, найдено {len(questions)} вопросов")
+                return questions
+            
+            logger.error("Не удалось исправить JSON")
+            # Попробуем извлечь отдельные вопросы с улучшенным парсингом
+            questions = extract_questions_from_broken_json(json_text)
+            if questions:
+                logger.info(f"Извлечено {len(questions)} вопросов из поврежденного JSON")
+                return questions
+            
+            return []
         else:
             logger.error("Не удалось извлечь JSON из ответа GPT")
-            return get_demo_questions()
+            return []
             
     except Exception as e:
         logger.error(f"Ошибка генерации тестовых вопросов: {str(e)}")
-        # Возвращаем демонстрационные вопросы в случае ошибки
-        return get_demo_questions()
+        # Пустой список: фоновая задача отметит генерацию как неудачную, и ее можно повторить.
+        # Демонстрационные вопросы только показываются и никогда не сохраняются в результат
+        return []
 
-def get_demo_questions():
-    """Возвращает демонстрационные вопросы для тестирования"""
-    return [
-        {
-            "id": 1,
-            "question": "Что такое машинное обучение?",
-            "options": {
-                "A": "Способность машин физически обучаться новым движениям",
-                "B": "Раздел ИИ, позволяющий компьютерам обучаться на данных",
-                "C": "Процесс обучения людей работе с машинами",
-                "D": "Автоматическое обновление программного обеспечения"
-            },
-            "correct_answer": "B",
-            "explanation": "Машинное обучение — это раздел искусственного интеллекта, который позволяет компьютерам обучаться и принимать решения на основе данных без явного программирования.",
-            "difficulty": 1,
-            "topic": "Основы ML"
+# Демонстрационные вопросы (общие для всех вызовов, не изменять на месте)
+_DEMO_QUESTIONS = (
+    {
+        "id": 1,
+        "question": "Что такое машинное обучение?",
+        "options": {
+            "A": "Способность машин физически обучаться новым движениям",
+            "B": "Раздел ИИ, позволяющий компьютерам обучаться на данных",
+            "C": "Процесс обучения людей работе с машинами",
+            "D": "Автоматическое обновление программного обеспечения"
         },
-        {
-            "id": 2,
-            "question": "Какие основные типы машинного обучения существуют?",
-            "options": {
-                "A": "Быстрое, медленное и среднее обучение",
-                "B": "Обучение с учителем, без учителя и с подкреплением",
-                "C": "Линейное, нелинейное и циклическое обучение",
-                "D": "Простое, сложное и экспертное обучение"
-            },
-            "correct_answer": "B",
-            "explanation": "Основные типы: supervised learning (с учителем), unsupervised learning (без учителя) и reinforcement learning (с подкреплением).",
-            "difficulty": 2,
-            "topic": "Типы обучения"
+        "correct_answer": "B",
+        "explanation": "Машинное обучение — это раздел искусственного интеллекта, который позволяет компьютерам обучаться и принимать решения на основе данных без явного программирования.",
+        "difficulty": 1,
+        "topic": "Основы ML"
+    },
+    {
+        "id": 2,
+        "question": "Какие основные типы машинного обучения существуют?",
+        "options": {
+            "A": "Быстрое, медленное и среднее обучение",
+            "B": "Обучение с учителем, без учителя и с подкреплением",
+            "C": "Линейное, нелинейное и циклическое обучение",
+            "D": "Простое, сложное и экспертное обучение"
         },
-        {
-            "id": 3,
-            "question": "Что происходит при переобучении модели?",
-            "options": {
-                "A": "Модель работает слишком быстро",
-                "B": "Модель потребляет много памяти",
-                "C": "Модель слишком хорошо запоминает обучающие данные",
-                "D": "Модель обучается дольше обычного"
-            },
-            "correct_answer": "C",
-            "explanation": "При переобучении модель слишком хорошо запоминает обучающие данные, включая шум, что ухудшает её работу на новых данных.",
-            "difficulty": 2,
-            "topic": "Проблемы обучения"
+        "correct_answer": "B",
+        "explanation": "Основные типы: supervised learning (с учителем), unsupervised learning (без учителя) и reinforcement learning (с подкреплением).",
+        "difficulty": 2,
+        "topic": "Типы обучения"
+    },
+    {
+        "id": 3,
+        "question": "Что происходит при переобучении модели?",
+        "options": {
+            "A": "Модель работает слишком быстро",
+            "B": "Модель потребляет много памяти",
+            "C": "Модель слишком хорошо запоминает обучающие данные",
+            "D": "Модель обучается дольше обычного"
         },
-        {
-            "id": 4,
-            "question": "Что такое нейронная сеть?",
-            "options": {
-                "A": "Сеть компьютеров для обработки данных",
-                "B": "Математическая модель, имитирующая работу нейронов мозга",
-                "C": "Программа для создания графиков",
-                "D": "База данных для хранения информации"
-            },
-            "correct_answer": "B",
-            "explanation": "Нейронная сеть — это математическая модель, построенная по принципу организации и функционирования биологических нейронных сетей.",
-            "difficulty": 1,
-            "topic": "Нейронные сети"
+        "correct_answer": "C",
+        "explanation": "При переобучении модель слишком хорошо запоминает обучающие данные, включая шум, что ухудшает её работу на новых данных.",
+        "difficulty": 2,
+        "topic": "Проблемы обучения"
+    },
+    {
+        "id": 4,
+        "question": "Что такое нейронная сеть?",
+        "options": {
+            "A": "Сеть компьютеров для обработки данных",
+            "B": "Математическая модель, имитирующая работу нейронов мозга",
+            "C": "Программа для создания графиков",
+            "D": "База данных для хранения информации"
         },
-        {
-            "id": 5,
-            "question": "Что такое градиентный спуск?",
-            "options": {
-                "A": "Метод физических упражнений",
-                "B": "Алгоритм оптимизации для минимизации функции потерь",
-                "C": "Способ сжатия данных",
-                "D": "Техника визуализации данных"
-            },
-            "correct_answer": "B",
-            "explanation": "Градиентный спуск — это итерационный алгоритм оптимизации, используемый для минимизации функции потерь путем движения в направлении наибольшего убывания градиента.",
-            "difficulty": 2,
-            "topic": "Оптимизация"
+        "correct_answer": "B",
+        "explanation": "Нейронная сеть — это математическая модель, построенная по принципу организации и функционирования биологических нейронных сетей.",
+        "difficulty": 1,
+        "topic": "Нейронные сети"
+    },
+    {
+        "id": 5,
+        "question": "Что такое градиентный спуск?",
+        "options": {
+            "A": "Метод физических упражнений",
+            "B": "Алгоритм оптимизации для минимизации функции потерь",
+            "C": "Способ сжатия данных",
+            "D": "Техника визуализации данных"
         },
-        {
-            "id": 6,
-            "question": "Что означает термин 'Big Data'?",
-            "options": {
-                "A": "Большие файлы на компьютере",
-                "B": "Наборы данных большого объема, скорости и разнообразия",
-                "C": "Дорогое программное обеспечение",
-                "D": "Быстрый интернет"
-            },
-            "correct_answer": "B",
-            "explanation": "Big Data характеризуется тремя V: Volume (объем), Velocity (скорость) и Variety (разнообразие) данных, которые сложно обрабатывать традиционными методами.",
-            "difficulty": 1,
-            "topic": "Big Data"
+        "correct_answer": "B",
+        "explanation": "Градиентный спуск — это итерационный алгоритм оптимизации, используемый для минимизации функции потерь путем движения в направлении наибольшего убывания градиента.",
+        "difficulty": 2,
+        "topic": "Оптимизация"
+    },
+    {
+        "id": 6,
+        "question": "Что означает термин 'Big Data'?",
+        "options": {
+            "A": "Большие файлы на компьютере",
+            "B": "Наборы данных большого объема, скорости и разнообразия",
+            "C": "Дорогое программное обеспечение",
+            "D": "Быстрый интернет"
         },
-        {
-            "id": 7,
-            "question": "Что такое кросс-валидация?",
-            "options": {
-                "A": "Проверка правописания в коде",
-                "B": "Метод оценки качества модели на разных подвыборках данных",
-                "C": "Способ шифрования данных",
-                "D": "Техника сжатия изображений"
-            },
-            "correct_answer": "B",
-            "explanation": "Кросс-валидация — это метод оценки обобщающей способности модели путем разделения данных на несколько частей и тестирования модели на каждой из них.",
-            "difficulty": 2,
-            "topic": "Валидация модели"
+        "correct_answer": "B",
+        "explanation": "Big Data характеризуется тремя V: Volume (объем), Velocity (скорость) и Variety (разнообразие) данных, которые сложно обрабатывать традиционными методами.",
+        "difficulty": 1,
+        "topic": "Big Data"
+    },
+    {
+        "id": 7,
+        "question": "Что такое кросс-валидация?",
+        "options": {
+            "A": "Проверка правописания в коде",
+            "B": "Метод оценки качества модели на разных подвыборках данных",
+            "C": "Способ шифрования данных",
+            "D": "Техника сжатия изображений"
         },
-        {
-            "id": 8,
-            "question": "Что такое признак (feature) в машинном обучении?",
-            "options": {
-                "A": "Ошибка в программе",
-                "B": "Индивидуальная измеримая характеристика объекта",
-                "C": "Тип алгоритма",
-                "D": "Результат работы модели"
-            },
-            "correct_answer": "B",
-            "explanation": "Признак — это индивидуальная измеримая характеристика или свойство наблюдаемого объекта, используемая в качестве входных данных для модели.",
-            "difficulty": 1,
-            "topic": "Признаки"
-        }
-    ]
+        "correct_answer": "B",
+        "explanation": "Кросс-валидация — это метод оценки обобщающей способности модели путем разделения данных на несколько частей и тестирования модели на каждой из них.",
+        "difficulty": 2,
+        "topic": "Валидация модели"
+    },
+    {
+        "id": 8,
+        "question": "Что такое признак (feature) в машинном обучении?",
+        "options": {
+            "A": "Ошибка в программе",
+            "B": "Индивидуальная измеримая характеристика объекта",
+            "C": "Тип алгоритма",
+            "D": "Результат работы модели"
+        },
+        "correct_answer": "B",
+        "explanation": "Признак — это индивидуальная измеримая характеристика или свойство наблюдаемого объекта, используемая в качестве входных данных для модели.",
+        "difficulty": 1,
+        "topic": "Признаки"
+    }
+)
+
+def get_demo_questions():
+    """Возвращает демонстрационные вопросы для тестирования"""
+    return _DEMO_QUESTIONS
+
+# Фоновая генерация тестовых вопросов: не больше одной задачи на результат.
+# Состояние хранится в строке result, чтобы его одинаково видели все воркеры gunicorn
+_test_gen_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='test-gen')
+
+# Генерация, не завершившаяся за это время, считается прерванной (воркер перезапущен)
+_TEST_GEN_TIMEOUT = '-15 minutes'
+
+def _set_test_questions_failed(result_id):
+    """Отметка неудачной генерации вопросов"""
+    with get_conn(write=True) as conn:
+        conn.execute("UPDATE result SET test_questions_status = 'failed' WHERE id = ?", (result_id,))
+        conn.commit()
+
+def _generate_test_questions_task(result_id, result_data):
+    """Генерация и сохранение тестовых вопросов (выполняется в пуле потоков)"""
+    try:
+        test_questions = generate_test_questions(result_data)
+        if not test_questions:
+            logger.warning(f"Не удалось сгенерировать тестовые вопросы для результата {result_id}")
+            _set_test_questions_failed(result_id)
+            return
+        
+        test_questions_json = to_json_text(test_questions)
+        with get_conn(write=True) as conn:
+            conn.execute('''
+                UPDATE result SET test_questions_json = ?, test_questions_status = NULL
+                WHERE id = ?
+            ''', (test_questions_json, result_id))
+            conn.commit()
+        invalidate_result(result_id)
+        logger.info(f"Сохранено {len(test_questions)} тестовых вопросов")
+    except Exception as e:
+        logger.error(f"Ошибка фоновой генерации тестовых вопросов: {str(e)}")
+        try:
+            _set_test_questions_failed(result_id)
+        except Exception as db_error:
+            logger.error(f"Не удалось сохранить статус генерации вопросов: {db_error}")
+
+def start_test_questions_generation(result_id, result_data):
+    """Ставит генерацию вопросов в очередь, если она еще не запущена ни одним воркером"""
+    # Захват в одном UPDATE: генерацию запускает только тот, кто перевел статус в 'generating'
+    with get_conn(write=True) as conn:
+        claimed = conn.execute('''
+            UPDATE result
+            SET test_questions_status = 'generating', test_questions_started_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+              AND COALESCE(json_array_length(test_questions_json), 0) = 0
+              AND (test_questions_status IS NOT 'generating'
+                   OR test_questions_started_at < datetime('now', ?))
+        ''', (result_id, _TEST_GEN_TIMEOUT)).rowcount
+        conn.commit()
+    if not claimed:
+        return False
+    _test_gen_executor.submit(_generate_test_questions_task, result_id, result_data)
+    return True
+
+# Интервалы SM-2 в днях для начального ease_factor=2.5, индекс - consecutive_correct
+_SM2_BASE_INTERVAL = (None, 1, 6) + tuple(int((n - 1) * 2.5) for n in range(3, 21))
+
+# Прогресс по вопросу, на который пользователь еще не отвечал (только для чтения)
+_DEFAULT_PROGRESS = {'consecutive_correct': 0, 'ease_factor': 2.5, 'next_review': None}
 
 @app.route('/test/<int:result_id>')
 def test_mode(result_id):
@@ -1684,28 +1834,36 @@ def test_mode(result_id):
     # Получаем предварительно сгенерированные тестовые вопросы
     test_questions = result_data.get('test_questions', [])
     
-    # Если вопросов нет, генерируем их сейчас (для старых результатов)
+    # Вопросы могли сохраниться в другом воркере, пока этот держал результат в кэше
     if not test_questions:
-        logger.info("Тестовые вопросы не найдены, генерируем...")
-        test_questions = generate_test_questions(result_data)
-        
-        if test_questions:
-            # Сохраняем сгенерированные вопросы в базу данных
-            conn = sqlite3.connect('ai_study.db')
-            c = conn.cursor()
-            test_questions_json = json.dumps(test_questions, ensure_ascii=False)
-            c.execute('UPDATE result SET test_questions_json = ? WHERE id = ?', 
-                     (test_questions_json, result_id))
-            conn.commit()
-            conn.close()
-            logger.info(f"Сохранено {len(test_questions)} тестовых вопросов")
-        else:
-            flash('Не удалось сгенерировать тестовые вопросы', 'warning')
-            return redirect(url_for('result', result_id=result_id))
+        invalidate_result(result_id)
+        result_data = get_result(result_id, check_access=True) or result_data
+        test_questions = result_data.get('test_questions', [])
+    
+    # После неудачной генерации можно потренироваться на демонстрационных вопросах;
+    # ответы на них не сохраняются
+    if not test_questions and request.args.get('demo'):
+        return render_template('test_mode.html',
+                             result_data=result_data,
+                             test_questions=[{**question, 'id': i, 'progress': _DEFAULT_PROGRESS}
+                                             for i, question in enumerate(get_demo_questions())],
+                             result_id=result_id,
+                             access_token=result_data.get('access_token'),
+                             demo=True)
+    
+    # Если вопросов нет, генерируем их в фоне (для старых результатов)
+    if not test_questions:
+        logger.info("Тестовые вопросы не найдены, запускаем генерацию...")
+        start_test_questions_generation(result_id, result_data)
+        return render_template('test_mode.html',
+                             result_data=result_data,
+                             test_questions=[],
+                             result_id=result_id,
+                             access_token=result_data.get('access_token'),
+                             generating=True)
     
     # Получаем прогресс пользователя
-    conn = sqlite3.connect('ai_study.db')
-    c = conn.cursor()
+    c = get_db().cursor()
     
     progress_data = {}
     if current_user.is_authenticated:
@@ -1715,26 +1873,17 @@ def test_mode(result_id):
             WHERE result_id = ? AND user_id = ?
         ''', (result_id, current_user.id))
         
-        for row in c.fetchall():
-            progress_data[row[0]] = {
-                'consecutive_correct': row[1],
-                'ease_factor': row[2],
-                'next_review': row[3]
-            }
-    
-    conn.close()
+        progress_data = {fcid: (cc, ef, nr) for fcid, cc, ef, nr in c.fetchall()}
     
-    # Добавляем прогресс к вопросам
-    for i, question in enumerate(test_questions):
-        question['id'] = i
-        if i in progress_data:
-            question['progress'] = progress_data[i]
-        else:
-            question['progress'] = {
-                'consecutive_correct': 0,
-                'ease_factor': 2.5,
-                'next_review': None
-            }
+    # Добавляем прогресс к вопросам (копии, чтобы не менять закэшированный результат)
+    test_questions = [
+        {**question, 'id': i, 'progress': {
+            'consecutive_correct': p[0],
+            'ease_factor': p[1],
+            'next_review': p[2]
+        } if (p := progress_data.get(i)) else _DEFAULT_PROGRESS}
+        for i, question in enumerate(test_questions)
+    ]
     
     return render_template('test_mode.html', 
                          result_data=result_data, 
@@ -1742,6 +1891,100 @@ def test_mode(result_id):
                          result_id=result_id,
                          access_token=result_data.get('access_token'))
 
+@app.route('/test/<int:result_id>/status')
+def test_generation_status(result_id):
+    """Статус фоновой генерации тестовых вопросов"""
+    c = get_db().cursor()
+    c.execute('''
+        SELECT user_id, COALESCE(json_array_length(test_questions_json), 0) > 0,
+               test_questions_status, test_questions_started_at < datetime('now', ?)
+        FROM result WHERE id = ?
+    ''', (_TEST_GEN_TIMEOUT, result_id))
+    row = c.fetchone()
+    
+    if not row or (current_user.is_authenticated and row[0] and row[0] != current_user.id):
+        return jsonify({'error': 'Результат не найден'}), 404
+    
+    user_id, has_questions, status, expired = row
+    # Готово только когда вопросы действительно есть: страница теста сразу перезагружается
+    if has_questions:
+        return jsonify({'status': 'ready'})
+    
+    if status == 'failed' or (status == 'generating' and expired):
+        return jsonify({'status': 'failed'})
+    
+    return jsonify({'status': 'generating'})
+
+def apply_test_answers(result_id, user_id, answers):
+    """Применение ответов теста к прогрессу (упрощенный SM-2) одной транзакцией.
+    
+    answers - список пар (flashcard_id, is_correct); возвращает новый прогресс по каждому ответу.
+    """
+    # Запись идет через общий замок записи процесса, как у остальных транзакций
+    with get_conn(write=True) as conn:
+        c = conn.cursor()
+        # Чтение и запись в одной транзакции, прогресс результата читается одним запросом
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('''
+            SELECT flashcard_id, consecutive_correct, ease_factor
+            FROM user_progress 
+            WHERE result_id = ? AND user_id = ?
+        ''', (result_id, user_id))
+        # Ключ - строка: id вопроса от GPT может прийти строкой, а SQLite сравнивает его с INTEGER по значению
+        progress = {str(flashcard_id): (consecutive_correct, ease_factor)
+                    for flashcard_id, consecutive_correct, ease_factor in c.fetchall()}
+        
+        # Следующая дата повторения в UTC, как CURRENT_TIMESTAMP и date('now') в SQLite
+        now = datetime.now(timezone.utc)
+        last_review = now.strftime('%Y-%m-%d %H:%M:%S')
+        rows = []
+        results = []
+        for flashcard_id, is_correct in answers:
+            consecutive_correct, ease_factor = progress.get(str(flashcard_id), (0, 2.5))
+        
+            if is_correct:
+                consecutive_correct += 1
+                if ease_factor == 2.5 and consecutive_correct < len(_SM2_BASE_INTERVAL):
+                    interval = _SM2_BASE_INTERVAL[consecutive_correct]
+                elif consecutive_correct == 1:
+                    interval = 1  # 1 день
+                elif consecutive_correct == 2:
+                    interval = 6  # 6 дней
+                else:
+                    interval = int((consecutive_correct - 1) * ease_factor)
+            
+                # ease_factor не меняется: поправка SM-2 для оценки 4 равна нулю
+            else:
+                consecutive_correct = 0
+                interval = 1
+                ease_factor = max(1.3, ease_factor - 0.2)
+        
+            # Повторный ответ на ту же карточку в пакете продолжает от уже обновленного прогресса
+            progress[str(flashcard_id)] = (consecutive_correct, ease_factor)
+            next_review_date = now + timedelta(days=interval)
+            rows.append((result_id, flashcard_id, user_id, last_review,
+                         next_review_date.strftime('%Y-%m-%d %H:%M:%S'), ease_factor, consecutive_correct))
+            results.append({
+                'consecutive_correct': consecutive_correct,
+                'next_review': next_review_date.strftime('%Y-%m-%d'),
+                'ease_factor': round(ease_factor, 2)
+            })
+        
+        # Сохраняем или обновляем прогресс
+        c.executemany('''
+            INSERT INTO user_progress 
+            (result_id, flashcard_id, user_id, last_review, next_review, ease_factor, consecutive_correct)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(result_id, flashcard_id, user_id) DO UPDATE SET
+                last_review = excluded.last_review,
+                next_review = excluded.next_review,
+                ease_factor = excluded.ease_factor,
+                consecutive_correct = excluded.consecutive_correct
+        ''', rows)
+        
+        conn.commit()
+    return results
+
 @app.route('/test/<int:result_id>/answer', methods=['POST'])
 def submit_test_answer(result_id):
     """Обработка ответа в режиме теста"""
@@ -1755,63 +1998,26 @@ def submit_test_answer(result_id):
     if flashcard_id is None:
         return jsonify({'error': 'Не указан ID карточки'}), 400
     
-    # Обновляем прогресс пользователя
-    conn = sqlite3.connect('ai_study.db')
-    c = conn.cursor()
-    
-    # Получаем текущий прогресс
-    c.execute('''
-        SELECT consecutive_correct, ease_factor, next_review
-        FROM user_progress 
-        WHERE result_id = ? AND flashcard_id = ? AND user_id = ?
-    ''', (result_id, flashcard_id, current_user.id))
-    
-    row = c.fetchone()
-    
-    if row:
-        consecutive_correct, ease_factor, next_review = row
-    else:
-        consecutive_correct = 0
-        ease_factor = 2.5
-        next_review = None
-    
-    # Алгоритм интервального повторения (упрощенный SM-2)
-    if is_correct:
-        consecutive_correct += 1
-        if consecutive_correct == 1:
-            interval = 1  # 1 день
-        elif consecutive_correct == 2:
-            interval = 6  # 6 дней
-        else:
-            interval = int((consecutive_correct - 1) * ease_factor)
-        
-        # Корректируем ease_factor
-        ease_factor = max(1.3, ease_factor + (0.1 - (5 - 4) * (0.08 + (5 - 4) * 0.02)))
-    else:
-        consecutive_correct = 0
-        interval = 1
-        ease_factor = max(1.3, ease_factor - 0.2)
-    
-    # Вычисляем следующую дату повторения
-    next_review_date = datetime.now() + timedelta(days=interval)
+    result, = apply_test_answers(result_id, current_user.id, [(flashcard_id, is_correct)])
+    return jsonify({'success': True, **result})
+
+@app.route('/test/<int:result_id>/answer_batch', methods=['POST'])
+def submit_test_answers_batch(result_id):
+    """Обработка пакета ответов теста одной транзакцией"""
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Необходима авторизация'}), 401
     
-    # Сохраняем или обновляем прогресс
-    c.execute('''
-        INSERT OR REPLACE INTO user_progress 
-        (result_id, flashcard_id, user_id, last_review, next_review, ease_factor, consecutive_correct)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (result_id, flashcard_id, current_user.id, datetime.now(), 
-          next_review_date, ease_factor, consecutive_correct))
+    data = request.get_json() or {}
+    answers = data.get('answers')
+    if not isinstance(answers, list) or not answers:
+        return jsonify({'error': 'Не указаны ответы'}), 400
     
-    conn.commit()
-    conn.close()
+    if any(not isinstance(answer, dict) or answer.get('flashcard_id') is None for answer in answers):
+        return jsonify({'error': 'Не указан ID карточки'}), 400
     
-    return jsonify({
-        'success': True,
-        'consecutive_correct': consecutive_correct,
-        'next_review': next_review_date.strftime('%Y-%m-%d'),
-        'ease_factor': round(ease_factor, 2)
-    })
+    results = apply_test_answers(result_id, current_user.id,
+                                 [(answer['flashcard_id'], answer.get('is_correct', False)) for answer in answers])
+    return jsonify({'success': True, 'results': results})
 
 @app.route('/test/<int:result_id>/stats')
 def test_stats(result_id):
@@ -1819,8 +2025,9 @@ def test_stats(result_id):
     if not current_user.is_authenticated:
         return jsonify({'error': 'Необходима авторизация'}), 401
     
-    conn = sqlite3.connect('ai_study.db')
-    c = conn.cursor()
+    # Агрегат читается прямо из idx_progress_cover, без кэша: локальный кэш процесса
+    # отставал бы от ответов, записанных другими воркерами gunicorn
+    c = get_db().cursor()
     
     # Общая статистика по результату
     c.execute('''
@@ -1834,7 +2041,6 @@ def test_stats(result_id):
     ''', (result_id, current_user.id))
     
     stats = c.fetchone()
-    conn.close()
     
     if stats and stats[0] > 0:
         return jsonify({
@@ -1910,7 +2116,7 @@ def upload_file():
             return redirect(url_for('index'))
         
         # Дополнительная проверка для PPTX файлов - проверяем план подписки
-        file_ext = Path(file.filename).suffix.lower()
+        file_ext = os.path.splitext(file.filename)[1].lower()
         if file_ext == '.pptx':
             allowed, message = subscription_manager.check_pptx_support(current_user.id)
             if not allowed:
@@ -1933,20 +2139,18 @@ def upload_file():
         logger.info(f"Secure filename: {original_filename}")
         
         # Сохраняем оригинальное расширение файла
-        file_ext = Path(original_filename).suffix.lower()
-        filename_without_ext = Path(original_filename).stem
+        filename_without_ext, secure_ext = os.path.splitext(original_filename)
         
         # Дополнительная проверка расширения
-        if not file_ext:
-            # Если расширение потерялось, попробуем извлечь из оригинального имени
-            original_ext = Path(file.filename).suffix.lower()
-            if original_ext:
-                file_ext = original_ext
-                logger.warning(f"Extension recovered from original filename: {file_ext}")
-            else:
-                logger.error(f"No file extension found in: {file.filename}")
-                flash('Ошибка: не удалось определить тип файла', 'danger')
-                return redirect(url_for('index'))
+        if secure_ext:
+            file_ext = secure_ext.lower()
+        elif file_ext:
+            # Расширение потерялось, берем его из оригинального имени
+            logger.warning(f"Extension recovered from original filename: {file_ext}")
+        else:
+            logger.error(f"No file extension found in: {file.filename}")
+            flash('Ошибка: не удалось определить тип файла', 'danger')
+            return redirect(url_for('index'))
         
         filename = f"{timestamp}_{filename_without_ext}{file_ext}"
         
@@ -1954,13 +2158,13 @@ def upload_file():
         logger.info(f"Final filename: {filename}")
         
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        save_uploaded_file(file, filepath)
         
         logger.info(f"File uploaded: {filename}")
         
         # Получение диапазона страниц/слайдов (для PDF и PPTX)
         page_range = None
-        file_type = Path(filename).suffix.lower()
+        file_type = file_ext
         if file_type in ['.pdf', '.pptx']:
             page_range = request.form.get('page_range', '').strip()
             if not page_range:
@@ -1969,11 +2173,7 @@ def upload_file():
                 logger.info(f"PDF page range specified: {page_range}")
                 # Проверка лимита страниц PDF
                 try:
-                    if '-' in page_range:
-                        start, end = map(int, page_range.split('-'))
-                        pages_count = end - start + 1
-                    else:
-                        pages_count = len(page_range.split(','))
+                    pages_count = sum(end - start + 1 for start, end in parse_page_range(page_range))
                     
                     allowed, message = subscription_manager.check_pdf_pages_limit(current_user.id, pages_count)
                     if not allowed:
@@ -1993,7 +2193,6 @@ def upload_file():
         
         # Создаем задачу анализа
         try:
-            from analysis_manager import analysis_manager
             task_id = analysis_manager.create_task(current_user.id, filename)
             
             # Запускаем анализ в фоновом режиме
@@ -2070,7 +2269,6 @@ def upload_video_url():
         logger.info(f"🎥 Starting video download from URL: {video_url}")
         
         # Создаем задачу анализа сначала
-        from analysis_manager import analysis_manager
         task_id = analysis_manager.create_task(current_user.id, f"video_from_url_{video_url}")
         
         # Загрузка видео с поддержкой отмены
@@ -2165,13 +2363,13 @@ def create_flashcard():
         
         # Добавляем ID к новой карте
         card_data['id'] = new_card_id
-        existing_flashcards.append(card_data)
+        existing_flashcards = existing_flashcards + [card_data]
         
         # Обновляем результат в базе данных
-        conn = sqlite3.connect('ai_study.db')
+        conn = get_db()
         c = conn.cursor()
         
-        flashcards_json = json.dumps(existing_flashcards, ensure_ascii=False)
+        flashcards_json = to_json_text(existing_flashcards)
         
         c.execute('''
             UPDATE result 
@@ -2180,7 +2378,7 @@ def create_flashcard():
         ''', (flashcards_json, result_id))
         
         conn.commit()
-        conn.close()
+        invalidate_result(result_id)
         
         logger.info(f"New flashcard created for result {result_id}, card ID: {new_card_id}")
         return jsonify({"success": True, "card_id": new_card_id})
@@ -2189,6 +2387,28 @@ def create_flashcard():
         logger.error(f"Error creating flashcard: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+def _flashcard_sm2(correct, confidence, ease_factor, consecutive):
+    """Переход SM-2 для повторной карточки: (new_ease, new_consecutive, interval_days)"""
+    if correct:
+        # Повышение сложности при правильном ответе с учетом уверенности
+        confidence_multiplier = confidence / 2.0  # 1=0.5, 2=1.0, 3=1.5
+        new_ease = min(2.5, ease_factor + (0.1 * confidence_multiplier))
+        new_consecutive = consecutive + 1
+        return new_ease, new_consecutive, max(1, int(new_consecutive * new_ease * confidence_multiplier))
+    # Понижение сложности при неправильном ответе
+    return max(1.3, ease_factor - 0.2), 0, 1
+
+# Таблица переходов SM-2 по ключу (correct, confidence, ease_factor * 20, consecutive_correct):
+# ease_factor меняется шагами по 0.05 в диапазоне [1.3, 2.5]
+SM2_TABLE_MAX_CONSECUTIVE = 50
+SM2_TABLE = {
+    (correct, confidence, ease_bucket, consecutive): _flashcard_sm2(correct, confidence, ease_bucket / 20, consecutive)
+    for correct in (False, True)
+    for confidence in (1, 2, 3)
+    for ease_bucket in range(26, 51)
+    for consecutive in range(SM2_TABLE_MAX_CONSECUTIVE + 1)
+}
+
 @app.route('/api/flashcard_progress', methods=['POST'])
 @login_required
 def update_flashcard_progress():
@@ -2209,66 +2429,59 @@ def update_flashcard_progress():
             
         logger.info(f"Updating flashcard progress: result_id={result_id}, flashcard_id={flashcard_id}, correct={correct}, confidence={confidence}")
         
-        conn = sqlite3.connect('ai_study.db')
-        c = conn.cursor()
-        
-        # Проверяем, что результат принадлежит текущему пользователю
-        c.execute('SELECT user_id FROM result WHERE id = ?', (result_id,))
-        result_owner = c.fetchone()
-        if not result_owner or result_owner[0] != current_user.id:
-            conn.close()
-            return jsonify({"success": False, "error": "Access denied"}), 403
-        
-        # Проверка существования прогресса
-        c.execute('''
-            SELECT id, ease_factor, consecutive_correct 
-            FROM user_progress 
-            WHERE result_id = ? AND flashcard_id = ? AND user_id = ?
-        ''', (result_id, flashcard_id, current_user.id))
-        
-        progress = c.fetchone()
-        
-        if progress:
-            # Обновление существующего прогресса
-            prog_id, ease_factor, consecutive = progress
-            
-            if correct:
-                # Повышение сложности при правильном ответе с учетом уверенности
-                confidence_multiplier = confidence / 2.0  # 1=0.5, 2=1.0, 3=1.5
-                new_ease = min(2.5, ease_factor + (0.1 * confidence_multiplier))
-                new_consecutive = consecutive + 1
-                interval_days = max(1, int(new_consecutive * new_ease * confidence_multiplier))
-            else:
-                # Понижение сложности при неправильном ответе
-                new_ease = max(1.3, ease_factor - 0.2)
-                new_consecutive = 0
-                interval_days = 1
+        with get_conn(write=True) as conn:
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
             
+            # Владелец результата и текущий прогресс карточки одним запросом
             c.execute('''
-                UPDATE user_progress 
-                SET last_review = CURRENT_TIMESTAMP,
-                    next_review = datetime('now', '+' || ? || ' days'),
-                    ease_factor = ?,
-                    consecutive_correct = ?
-                WHERE id = ?
-            ''', (interval_days, new_ease, new_consecutive, prog_id))
-        else:
-            # Создание новой истории прогресса
-            if correct:
-                interval_days = max(1, confidence)  # 1-3 дня в зависимости от уверенности
-                consecutive = 1
+                SELECT r.user_id, p.ease_factor, p.consecutive_correct
+                FROM result r
+                LEFT JOIN user_progress p
+                    ON p.result_id = r.id AND p.flashcard_id = ? AND p.user_id = ?
+                WHERE r.id = ?
+            ''', (flashcard_id, current_user.id, result_id))
+            row = c.fetchone()
+            
+            # Проверяем, что результат принадлежит текущему пользователю
+            if not row or row[0] != current_user.id:
+                return jsonify({"success": False, "error": "Access denied"}), 403
+            
+            _, ease_factor, consecutive = row
+            
+            if consecutive is not None:
+                # Обновление существующего прогресса; вне таблицы считаем напрямую
+                transition = SM2_TABLE.get((bool(correct), confidence, round(ease_factor * 20), consecutive))
+                if transition is None:
+                    transition = _flashcard_sm2(correct, confidence, ease_factor, consecutive)
+                new_ease, new_consecutive, interval_days = transition
             else:
-                interval_days = 1
-                consecutive = 0
-                
+                # Создание новой истории прогресса
+                new_ease = 2.5
+                if correct:
+                    interval_days = max(1, confidence)  # 1-3 дня в зависимости от уверенности
+                    new_consecutive = 1
+                else:
+                    interval_days = 1
+                    new_consecutive = 0
+            
+            # Время в UTC, в формате CURRENT_TIMESTAMP
+            now = datetime.now(timezone.utc)
+            next_review = now + timedelta(days=interval_days)
+            
             c.execute('''
                 INSERT INTO user_progress 
                 (result_id, flashcard_id, user_id, last_review, next_review, ease_factor, consecutive_correct)
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP, datetime('now', '+' || ? || ' days'), 2.5, ?)
-            ''', (result_id, flashcard_id, current_user.id, interval_days, consecutive))
-        
-        conn.commit()
-        conn.close()
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(result_id, flashcard_id, user_id) DO UPDATE SET
+                    last_review = excluded.last_review,
+                    next_review = excluded.next_review,
+                    ease_factor = excluded.ease_factor,
+                    consecutive_correct = excluded.consecutive_correct
+            ''', (result_id, flashcard_id, current_user.id, now.strftime('%Y-%m-%d %H:%M:%S'),
+                  next_review.strftime('%Y-%m-%d %H:%M:%S'), new_ease, new_consecutive))
+            
+            conn.commit()
         
         logger.info(f"Flashcard progress updated successfully. Next review in {interval_days} days")
         return jsonify({"success": True, "next_review_days": interval_days})
@@ -2309,24 +2522,9 @@ def download_flashcards_old(result_id):
         "mind_map": data.get('mind_map', {})
     }
     
-    # Создание JSON файла
-    json_content = json.dumps(export_data, ensure_ascii=False, indent=2)
-    
-    temp_filename = f"ai_study_export_{result_id}.json"
-    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
-    
-    with open(temp_path, 'w', encoding='utf-8') as f:
-        f.write(json_content)
-    
-    def remove_file(response):
-        try:
-            os.remove(temp_path)
-        except Exception:
-            pass
-        return response
-    
+    # Создание JSON файла в памяти
     return send_file(
-        temp_path,
+        io.BytesIO(export_json_bytes(export_data)),
         as_attachment=True,
         download_name=f"ai_study_{datetime.now().strftime('%Y%m%d')}.json",
         mimetype='application/json'
@@ -2341,39 +2539,60 @@ def get_mind_map_data(result_id):
     
     return jsonify(data.get('mind_map', {}))
 
+# Ответ прогресса для результата без флеш-карт
+_EMPTY_STUDY_PROGRESS = {
+    "total_cards": 0,
+    "reviewed_cards": 0,
+    "mastered_cards": 0,
+    "progress_percentage": 0,
+    "card_progress": []
+}
+
 @app.route('/api/study_progress/<int:result_id>')
 def get_study_progress(result_id):
     """Получение прогресса пользователя"""
     try:
-        conn = sqlite3.connect('ai_study.db')
-        c = conn.cursor()
-        
-        # Получение прогресса флеш-карт
-        c.execute('''
-            SELECT flashcard_id, last_review, next_review, 
-                   ease_factor, consecutive_correct
-            FROM user_progress
-            WHERE result_id = ?
-        ''', (result_id,))
-        
-        progress_data = []
-        for row in c.fetchall():
-            progress_data.append({
-                "flashcard_id": row[0],
-                "last_review": row[1],
-                "next_review": row[2],
-                "ease_factor": row[3],
-                "consecutive_correct": row[4]
-            })
+        with get_conn() as conn:
+            c = conn.cursor()
+            
+            # Число карточек считаем в SQLite, не разбирая весь результат
+            c.execute('SELECT json_array_length(flashcards_json), user_id FROM result WHERE id = ?', (result_id,))
+            result_row = c.fetchone()
+            if not result_row or (current_user.is_authenticated and result_row[1]
+                                  and result_row[1] != current_user.id):
+                return jsonify({"error": "Not found"}), 404
+            total_cards = result_row[0] or 0
+            
+            # Карточек еще нет - прогресс читать незачем
+            if not total_cards:
+                return json_response(_EMPTY_STUDY_PROGRESS)
+            
+            # Получение прогресса флеш-карт
+            c.execute('''
+                SELECT flashcard_id, last_review, next_review, 
+                       ease_factor, consecutive_correct
+                FROM user_progress
+                WHERE result_id = ?
+            ''', (result_id,))
+            rows = c.fetchall()
+        
+        # Ответ собирается уже после возврата соединения в пул
+        progress_data = [
+            {
+                "flashcard_id": flashcard_id,
+                "last_review": last_review,
+                "next_review": next_review,
+                "ease_factor": ease_factor,
+                "consecutive_correct": consecutive_correct
+            }
+            for flashcard_id, last_review, next_review, ease_factor, consecutive_correct in rows
+        ]
         
         # Подсчет прогресса
-        total_cards = len(get_result(result_id)['flashcards'])
         reviewed_cards = len(progress_data)
         mastered_cards = sum(1 for p in progress_data if p['consecutive_correct'] >= 3)
         
-        conn.close()
-        
-        return jsonify({
+        return json_response({
             "total_cards": total_cards,
             "reviewed_cards": reviewed_cards,
             "mastered_cards": mastered_cards,
@@ -2385,6 +2604,106 @@ def get_study_progress(result_id):
         logger.error(f"Error getting study progress: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# ml тянет torch и whisperx, поэтому импортируется один раз при первом сообщении чата
+_chat_response_fn = None
+
+def get_chat_response(user_message, full_text, result_data):
+    """Ответ ChatGPT по тексту лекции (ml.get_chat_response)"""
+    global _chat_response_fn
+    if _chat_response_fn is None:
+        from ml import get_chat_response as _chat_response_fn
+    return _chat_response_fn(user_message, full_text, result_data)
+
+# Очередь записи истории чата: сообщения пишутся пачками в одной транзакции.
+# Гарантия доставки - "не более одного раза": сообщение попадает в БД в течение
+# CHAT_FLUSH_INTERVAL после ответа (история, запрошенная сразу, может его еще не содержать),
+# при штатной остановке процесса очередь дописывается, а при SIGKILL или таймауте
+# воркера незаписанные сообщения теряются
+CHAT_BATCH_SIZE = 32
+CHAT_FLUSH_INTERVAL = 0.05
+chat_write_queue = queue.Queue()
+_CHAT_WRITER_STOP = object()
+
+# Поток записи запускается при первом сообщении в каждом процессе: поток,
+# запущенный при импорте, не переживает fork воркеров gunicorn (--preload)
+_chat_writer_thread = None
+_chat_writer_pid = None
+_chat_writer_lock = threading.Lock()
+
+def _flush_chat_history(rows):
+    """Запись пачки сообщений чата одной транзакцией"""
+    try:
+        with get_conn(write=True) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('''
+                INSERT INTO chat_history (result_id, user_id, user_message, ai_response)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error saving chat history batch ({len(rows)} rows): {str(e)}")
+
+def _award_chat_xp(rows):
+    """Начисление XP за сообщения чата, уже записанные в историю.
+    
+    Достижение ai_messages считает строки chat_history, поэтому XP начисляется после записи пачки
+    """
+    for result_id, user_id, user_message, _ in rows:
+        try:
+            gamification.award_xp(
+                user_id,
+                'ai_chat_message',
+                f'Вопрос в AI чате: {user_message[:50]}...',
+                {'result_id': result_id, 'message_length': len(user_message)}
+            )
+        except Exception as e:
+            logger.error(f"Error awarding chat XP to user {user_id}: {str(e)}")
+
+def _chat_history_writer():
+    """Фоновый поток: собирает до CHAT_BATCH_SIZE сообщений за CHAT_FLUSH_INTERVAL"""
+    stopping = False
+    while not stopping:
+        item = chat_write_queue.get()
+        if item is _CHAT_WRITER_STOP:
+            break
+        rows = [item]
+        deadline = time.monotonic() + CHAT_FLUSH_INTERVAL
+        while len(rows) < CHAT_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = chat_write_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _CHAT_WRITER_STOP:
+                stopping = True
+                break
+            rows.append(item)
+        _flush_chat_history(rows)
+        _award_chat_xp(rows)
+
+def save_chat_message(result_id, user_id, user_message, ai_response):
+    """Постановка сообщения чата в очередь записи (с запуском потока записи в этом процессе)"""
+    global _chat_writer_thread, _chat_writer_pid
+    with _chat_writer_lock:
+        if _chat_writer_pid != os.getpid() or not _chat_writer_thread.is_alive():
+            _chat_writer_thread = threading.Thread(target=_chat_history_writer,
+                                                   name='chat-history-writer', daemon=True)
+            _chat_writer_thread.start()
+            _chat_writer_pid = os.getpid()
+    chat_write_queue.put((result_id, user_id, user_message, ai_response))
+
+def _drain_chat_history():
+    """Остановка фонового потока при завершении процесса: он дописывает все, что уже взял из очереди"""
+    with _chat_writer_lock:
+        if _chat_writer_pid != os.getpid():
+            return  # В этом процессе сообщений не было
+    chat_write_queue.put(_CHAT_WRITER_STOP)
+    _chat_writer_thread.join(timeout=10)
+
+atexit.register(_drain_chat_history)
+
 @app.route('/api/chat/<int:result_id>', methods=['POST'])
 @login_required
 def chat_with_lecture(result_id):
@@ -2417,35 +2736,14 @@ def chat_with_lecture(result_id):
         if not full_text:
             return jsonify({"success": False, "error": "No lecture text available for chat"}), 400
             
-        # Импортируем OpenAI клиент из ml.py
-        from ml import get_chat_response
-        
         # Получаем ответ от ChatGPT
         ai_response = get_chat_response(user_message, full_text, result_data)
         
         # Записываем использование AI чата ПОСЛЕ успешного получения ответа
         subscription_manager.record_usage(current_user.id, 'ai_chat', 1, f'chat_message_{result_id}')
         
-        # Сохраняем в историю чата
-        conn = sqlite3.connect('ai_study.db')
-        c = conn.cursor()
-        
-        c.execute('''
-            INSERT INTO chat_history (result_id, user_id, user_message, ai_response)
-            VALUES (?, ?, ?, ?)
-        ''', (result_id, current_user.id, user_message, ai_response))
-        
-        conn.commit()
-        conn.close()
-        
-        # Начисление XP за AI чат
-        if current_user.is_authenticated:
-            gamification.award_xp(
-                current_user.id,
-                'ai_chat_message',
-                f'Вопрос в AI чате: {user_message[:50]}...',
-                {'result_id': result_id, 'message_length': len(user_message)}
-            )
+        # Сохраняем в историю чата; фоновый поток пишет пачку и затем начисляет XP за AI чат
+        save_chat_message(result_id, current_user.id, user_message, ai_response)
         
         logger.info(f"Chat message processed for result {result_id} by user {current_user.id}")
         return jsonify({
@@ -2458,6 +2756,25 @@ def chat_with_lecture(result_id):
         logger.error(f"Error in chat: {str(e)}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+# Кэш занятости email: AJAX-проверка дергается на каждую паузу при вводе
+_email_exists_cache = TTLCache(maxsize=1024, ttl=60)
+_email_exists_cache_lock = threading.Lock()
+
+def _email_exists(email):
+    """Проверка, зарегистрирован ли email (с кэшированием на 60 секунд)"""
+    with _email_exists_cache_lock:
+        exists = _email_exists_cache.get(email)
+    if exists is None:
+        exists = User.get_by_email(email) is not None
+        with _email_exists_cache_lock:
+            _email_exists_cache[email] = exists
+    return exists
+
+def forget_email(email):
+    """Сброс закэшированного результата проверки email"""
+    with _email_exists_cache_lock:
+        _email_exists_cache.pop(email, None)
+
 @app.route('/api/check_email', methods=['POST'])
 def check_email():
     """Проверка существования email для AJAX запросов"""
@@ -2471,14 +2788,11 @@ def check_email():
             return jsonify({"error": "Email is required"}), 400
         
         # Простая валидация email
-        import re
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, email):
+        if not is_valid_email(email):
             return jsonify({"exists": False, "valid": False, "message": "Неверный формат email"})
         
         # Проверяем существование пользователя
-        user = User.get_by_email(email)
-        if user:
+        if _email_exists(email):
             return jsonify({"exists": True, "valid": True, "message": "Пользователь с таким email уже существует"})
         else:
             return jsonify({"exists": False, "valid": True, "message": "Email доступен"})
@@ -2496,27 +2810,21 @@ def get_chat_history(result_id):
         if not result_data:
             return jsonify({"error": "Lecture not found"}), 404
             
-        conn = sqlite3.connect('ai_study.db')
-        c = conn.cursor()
-        
-        c.execute('''
-            SELECT user_message, ai_response, created_at
-            FROM chat_history
-            WHERE result_id = ?
-            ORDER BY created_at ASC
-        ''', (result_id,))
-        
-        history = []
-        for row in c.fetchall():
-            history.append({
-                "user_message": row[0],
-                "ai_response": row[1],
-                "timestamp": row[2]
-            })
-        
-        conn.close()
-        
-        return jsonify({
+        with get_conn() as conn:
+            rows = conn.execute('''
+                SELECT user_message, ai_response, created_at
+                FROM chat_history
+                WHERE result_id = ?
+                ORDER BY created_at ASC, id ASC
+            ''', (result_id,)).fetchall()
+        
+        # Ответ собирается уже после возврата соединения в пул
+        history = [
+            {"user_message": user_message, "ai_response": ai_response, "timestamp": created_at}
+            for user_message, ai_response, created_at in rows
+        ]
+        
+        return json_response({
             "success": True,
             "history": history,
             "lecture_title": result_data.get('filename', 'Лекция')
@@ -2526,45 +2834,6 @@ def get_chat_history(result_id):
         logger.error(f"Error getting chat history: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-# API endpoints
-@app.route('/api/check_email', methods=['POST'])
-def api_check_email():
-    """API для проверки доступности email"""
-    try:
-        data = request.get_json()
-        email = data.get('email', '').strip().lower()
-        
-        if not email:
-            return jsonify({'error': True, 'message': 'Email не указан'})
-        
-        # Валидация формата email
-        import re
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, email):
-            return jsonify({
-                'valid': False,
-                'message': 'Неверный формат email адреса'
-            })
-        
-        # Проверка существования пользователя
-        existing_user = User.get_by_email(email)
-        if existing_user:
-            return jsonify({
-                'valid': True,
-                'exists': True,
-                'message': 'Пользователь с таким email уже зарегистрирован'
-            })
-        
-        return jsonify({
-            'valid': True,
-            'exists': False,
-            'message': 'Email доступен для регистрации'
-        })
-        
-    except Exception as e:
-        logger.error(f"Error checking email: {str(e)}")
-        return jsonify({'error': True, 'message': 'Ошибка сервера'})
-
 @app.route('/api/login', methods=['POST'])
 def api_login():
     """API для входа через модальное окно"""
@@ -2585,12 +2854,9 @@ def api_login():
                 login_user(user, remember=remember)
                 
                 # Обновляем время последнего входа
-                conn = sqlite3.connect('ai_study.db')
-                c = conn.cursor()
-                c.execute('UPDATE users SET last_login = ? WHERE id = ?', 
-                         (datetime.now(), user.id))
-                conn.commit()
-                conn.close()
+                with get_conn(write=True) as conn:
+                    conn.execute('UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?', (user.id,))
+                    conn.commit()
                 
                 logger.info(f"User logged in via API: {email}")
                 return jsonify({'success': True, 'message': 'Успешный вход'})
@@ -2626,9 +2892,7 @@ def api_register():
             return jsonify({'success': False, 'error': 'Подтверждение пароля обязательно'})
         
         # Валидация email
-        import re
-        email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-        if not re.match(email_pattern, email):
+        if not is_valid_email(email):
             return jsonify({'success': False, 'error': 'Неверный формат email адреса'})
         
         # Валидация имени пользователя
@@ -2654,6 +2918,7 @@ def api_register():
         
         # Создаем пользователя
         user = User.create(email, username, password)
+        forget_email(email)
         if user:
             login_user(user)
             logger.info(f"New user registered via API: {email}")
@@ -2670,22 +2935,23 @@ def api_register():
 def delete_result_api(result_id):
     """API для удаления результата"""
     try:
-        # Проверяем права доступа
-        result_data = get_result(result_id, check_access=True)
-        if not result_data:
-            return jsonify({'error': True, 'message': 'Результат не найден или нет доступа'})
-        
-        # Удаляем из базы данных
-        conn = sqlite3.connect('ai_study.db')
-        c = conn.cursor()
-        
-        # Удаляем связанные данные
-        c.execute('DELETE FROM user_progress WHERE result_id = ?', (result_id,))
-        c.execute('DELETE FROM chat_history WHERE result_id = ?', (result_id,))
-        c.execute('DELETE FROM result WHERE id = ? AND user_id = ?', (result_id, current_user.id))
-        
-        conn.commit()
-        conn.close()
+        # Удаляем из базы данных одной транзакцией
+        with get_conn(write=True) as conn:
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            
+            # Права доступа проверяются самим удалением: чужой результат не затрагивается
+            c.execute('DELETE FROM result WHERE id = ? AND user_id = ?', (result_id, current_user.id))
+            if c.rowcount == 0:
+                conn.rollback()
+                return jsonify({'error': True, 'message': 'Результат не найден или нет доступа'})
+            
+            # Удаляем связанные данные
+            c.execute('DELETE FROM user_progress WHERE result_id = ?', (result_id,))
+            c.execute('DELETE FROM chat_history WHERE result_id = ?', (result_id,))
+            
+            conn.commit()
+        invalidate_result(result_id)
         
         logger.info(f"Result {result_id} deleted by user {current_user.id}")
         return jsonify({'success': True, 'message': 'Результат успешно удален'})
@@ -2713,19 +2979,11 @@ def download_flashcards(result_id):
             'topics': result_data['topics_data']
         }
         
-        # Создаем временный файл
-        import tempfile
-        import json
-        
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False, encoding='utf-8') as f:
-            json.dump(export_data, f, ensure_ascii=False, indent=2)
-            temp_path = f.name
-        
-        # Отправляем файл
+        # Отправляем файл прямо из памяти
         safe_filename = secure_filename(f"flashcards_{result_data['filename']}.json")
         
         return send_file(
-            temp_path,
+            io.BytesIO(export_json_bytes(export_data)),
             as_attachment=True,
             download_name=safe_filename,
             mimetype='application/json'
@@ -2763,7 +3021,6 @@ def track_interaction():
         # Получаем session_id из сессии или создаем новый
         session_id = session.get('analytics_session_id')
         if not session_id:
-            import uuid
             session_id = str(uuid.uuid4())
             session['analytics_session_id'] = session_id
             
@@ -2911,7 +3168,7 @@ def get_user_engagement():
 def start_study_session(session_id):
     """Запуск учебной сессии"""
     try:
-        conn = sqlite3.connect('ai_study.db')
+        conn = get_db()
         c = conn.cursor()
         
         # Проверяем, что сессия принадлежит текущему пользователю
@@ -2927,19 +3184,18 @@ def start_study_session(session_id):
         # Обновляем статус сессии
         c.execute('''
             UPDATE study_sessions 
-            SET status = 'in_progress', started_at = ?
+            SET status = 'in_progress', started_at = CURRENT_TIMESTAMP
             WHERE id = ?
-        ''', (datetime.now(), session_id))
+        ''', (session_id,))
         
         # Записываем активность
         c.execute('''
             INSERT INTO session_activities 
             (session_id, user_id, activity_type, created_at)
-            VALUES (?, ?, ?, ?)
-        ''', (session_id, current_user.id, 'session_started', datetime.now()))
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (session_id, current_user.id, 'session_started'))
         
         conn.commit()
-        conn.close()
         
         return jsonify({'success': True, 'message': 'Сессия запущена'})
         
@@ -2958,7 +3214,7 @@ def complete_study_session(session_id):
         cards_mastered = data.get('cards_mastered', 0)
         notes = data.get('notes', '')
         
-        conn = sqlite3.connect('ai_study.db')
+        conn = get_db()
         c = conn.cursor()
         
         # Проверяем, что сессия принадлежит текущему пользователю
@@ -2974,21 +3230,20 @@ def complete_study_session(session_id):
         # Обновляем статус сессии
         c.execute('''
             UPDATE study_sessions 
-            SET status = 'completed', completed_at = ?, progress = 100
+            SET status = 'completed', completed_at = CURRENT_TIMESTAMP, progress = 100
             WHERE id = ?
-        ''', (datetime.now(), session_id))
+        ''', (session_id,))
         
         # Записываем активность
         c.execute('''
             INSERT INTO session_activities 
             (session_id, user_id, activity_type, duration_seconds, 
              cards_reviewed, cards_mastered, notes, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
         ''', (session_id, current_user.id, 'session_completed', duration_seconds,
-              cards_reviewed, cards_mastered, notes, datetime.now()))
+              cards_reviewed, cards_mastered, notes))
         
         conn.commit()
-        conn.close()
         
         return jsonify({'success': True, 'message': 'Сессия завершена'})
         
@@ -3001,7 +3256,7 @@ def complete_study_session(session_id):
 def reset_user_sessions():
     """Сброс всех сессий пользователя (для пересоздания)"""
     try:
-        conn = sqlite3.connect('ai_study.db')
+        conn = get_db()
         c = conn.cursor()
         
         # Удаляем все сессии пользователя
@@ -3009,7 +3264,6 @@ def reset_user_sessions():
         c.execute('DELETE FROM study_sessions WHERE user_id = ?', (current_user.id,))
         
         conn.commit()
-        conn.close()
         
         return jsonify({'success': True, 'message': 'Сессии сброшены'})
         
@@ -3269,7 +3523,7 @@ def get_smart_notifications():
             
             if user_rank and user_rank <= 5:
                 # Проверяем, изменилась ли позиция пользователя
-                conn = sqlite3.connect('ai_study.db')
+                conn = get_db()
                 c = conn.cursor()
                 
                 c.execute('SELECT last_leaderboard_rank FROM users WHERE id = ?', (current_user.id,))
@@ -3318,8 +3572,6 @@ def get_smart_notifications():
                         ]
                     })
                 
-                conn.close()
-        
         # Записываем показ уведомлений для аналитики
         for notification in notifications:
             if notification['type'] == 'upgrade':
@@ -3394,7 +3646,6 @@ def gamification_dashboard():
         leaderboard = gamification.get_leaderboard(10)
         
         # Получаем доступные достижения
-        from gamification import ACHIEVEMENTS
         available_achievements = []
         unlocked_ids = set(a['id'] for a in user_data['achievements'])
         
@@ -3507,8 +3758,6 @@ def cancel_analysis_task(task_id):
     logger.info(f"🔴 Получен запрос на отмену задачи {task_id} от пользователя {current_user.id}")
     
     try:
-        from analysis_manager import analysis_manager
-        
         logger.info(f"📋 Вызываем analysis_manager.cancel_task({task_id}, {current_user.id})")
         success = analysis_manager.cancel_task(task_id, current_user.id)
         
@@ -3537,8 +3786,6 @@ def cancel_analysis_task(task_id):
 def get_analysis_status(task_id):
     """API для получения статуса задачи анализа"""
     try:
-        from analysis_manager import analysis_manager
-        
         task_status = analysis_manager.get_task_status(task_id, current_user.id)
         
         if not task_status:
@@ -3549,11 +3796,10 @@ def get_analysis_status(task_id):
         
         # Если задача завершена, получаем access_token результата
         if task_status['status'] == 'completed' and task_status['result_id']:
-            conn = sqlite3.connect('ai_study.db')
+            conn = get_db()
             c = conn.cursor()
             c.execute('SELECT access_token FROM result WHERE id = ?', (task_status['result_id'],))
             result = c.fetchone()
-            conn.close()
             
             if result:
                 task_status['access_token'] = result[0]
@@ -3575,7 +3821,7 @@ def get_analysis_status(task_id):
 def get_active_tasks():
     """API для получения активных задач пользователя"""
     try:
-        conn = sqlite3.connect('ai_study.db')
+        conn = get_db()
         c = conn.cursor()
         
         c.execute('''
@@ -3598,8 +3844,6 @@ def get_active_tasks():
                 'current_stage': current_stage or 'Подготовка'
             })
         
-        conn.close()
-        
         logger.info(f"Found {len(tasks)} active tasks for user {current_user.id}")
         
         return jsonify({
@@ -3631,8 +3875,6 @@ def cleanup_files():
                 'error': 'Доступ запрещен'
             }), 403
         
-        from analysis_manager import analysis_manager
-        
         # Получаем параметры из запроса
         data = request.get_json() or {}
         upload_folder = data.get('upload_folder', 'uploads')
@@ -3661,9 +3903,6 @@ def cleanup_files():
 def cleanup_status():
     """API для получения статистики файлов в папке uploads"""
     try:
-        import os
-        import time
-        
         upload_folder = 'uploads'
         
         if not os.path.exists(upload_folder):
@@ -3685,7 +3924,7 @@ def cleanup_status():
         max_age_hours = 24
         
         # Получаем активные файлы из БД
-        conn = sqlite3.connect('ai_study.db')
+        conn = get_db()
         c = conn.cursor()
         
         c.execute('''
@@ -3699,8 +3938,6 @@ def cleanup_status():
             if filename and not filename.startswith('video_from_url_'):
                 active_files.add(filename)
         
-        conn.close()
-        
         # Анализируем файлы
         for filename in os.listdir(upload_folder):
             filepath = os.path.join(upload_folder, filename)
@@ -3739,9 +3976,6 @@ def cleanup_status():
 
 def start_background_cleanup():
     """Запуск фоновой очистки файлов"""
-    import threading
-    import time
-    
     def cleanup_worker():
         """Рабочий поток для периодической очистки"""
         while True:
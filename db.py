@@ -0,0 +1,105 @@
+"""
+Модуль работы с базой данных SQLite
+"""
+import sqlite3
+import queue
+import threading
+import logging
+import atexit
+from contextlib import contextmanager
+from flask import g
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'ai_study.db'
+POOL_SIZE = 8
+# Размер кэша подготовленных выражений на соединение (по тексту SQL)
+STATEMENT_CACHE_SIZE = 256
+
+# Пул простаивающих соединений; при пустом пуле открывается новое соединение,
+# лишние соединения при возврате закрываются
+_pool = queue.Queue(maxsize=POOL_SIZE)
+
+# Писатель в SQLite всегда один: пишущие блоки процесса выстраиваются в очередь
+# на этой блокировке, а не крутятся в busy-ожидании. Читатели в WAL не ждут
+_write_lock = threading.Lock()
+
+
+def _connect():
+    """Открытие нового соединения с настройками производительности"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=268435456')
+    return conn
+
+
+def acquire():
+    """Получение соединения из пула"""
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return _connect()
+
+
+def release(conn):
+    """Возврат соединения в пул с откатом незавершенной транзакции"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
+
+
+@contextmanager
+def get_conn(write=False):
+    """Соединение из пула на время блока with (write=True - эксклюзивно для записи)"""
+    if write:
+        _write_lock.acquire()
+    conn = acquire()
+    try:
+        yield conn
+    finally:
+        release(conn)
+        if write:
+            _write_lock.release()
+
+
+def get_db():
+    """Соединение текущего запроса, возвращается в пул по его окончании"""
+    if 'db' not in g:
+        g.db = acquire()
+    return g.db
+
+
+def release_db(exc=None):
+    """Возврат соединения запроса в пул"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        release(conn)
+
+
+def close_pool():
+    """Закрытие простаивающих соединений с сохранением статистики планировщика"""
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            conn.execute('PRAGMA optimize')
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Error closing pooled connection: {str(e)}")
+
+
+atexit.register(close_pool)
+
+
+def init_app(app):
+    """Регистрация обработчиков соединения в приложении Flask"""
+    app.teardown_appcontext(release_db)
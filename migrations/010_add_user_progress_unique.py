@@ -0,0 +1,56 @@
+"""
+Миграция 010: Уникальная запись прогресса на карточку пользователя
+
+Ответы теста и повторения карточек пишутся через
+INSERT ... ON CONFLICT(result_id, flashcard_id, user_id), которому нужен уникальный индекс
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+def up(conn):
+    """Применение миграции"""
+    c = conn.cursor()
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_progress (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            result_id INTEGER,
+            flashcard_id INTEGER,
+            user_id INTEGER,
+            last_review TIMESTAMP,
+            next_review TIMESTAMP,
+            ease_factor REAL DEFAULT 2.5,
+            consecutive_correct INTEGER DEFAULT 0,
+            FOREIGN KEY (result_id) REFERENCES result(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+
+    # В старых базах user_id в user_progress появился не сразу
+    c.execute("PRAGMA table_info(user_progress)")
+    columns = [row[1] for row in c.fetchall()]
+    if 'user_id' not in columns:
+        c.execute('ALTER TABLE user_progress ADD COLUMN user_id INTEGER')
+        logger.info("Added user_id column to user_progress table")
+
+    # INSERT OR REPLACE без ключа плодил дубликаты - оставляем последнюю запись
+    c.execute('''
+        DELETE FROM user_progress WHERE id NOT IN (
+            SELECT MAX(id) FROM user_progress GROUP BY result_id, flashcard_id, user_id
+        )
+    ''')
+    if c.rowcount:
+        logger.info(f"Removed {c.rowcount} duplicate user_progress rows")
+
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_progress_unique
+        ON user_progress(result_id, flashcard_id, user_id)
+    ''')
+
+    logger.info("Migration 010 completed: unique index on user_progress")
+
+def down(conn):
+    """Откат миграции"""
+    c = conn.cursor()
+    c.execute('DROP INDEX IF EXISTS idx_progress_unique')
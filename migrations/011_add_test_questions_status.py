@@ -0,0 +1,34 @@
+"""
+Миграция 011: Статус фоновой генерации тестовых вопросов в таблице result
+
+Статус хранится в строке результата, чтобы его одинаково видели все воркеры gunicorn
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+def up(conn):
+    """Применение миграции"""
+    c = conn.cursor()
+
+    c.execute("PRAGMA table_info(result)")
+    columns = [row[1] for row in c.fetchall()]
+    if not columns:
+        # Таблицы еще нет: init_db создаст ее сразу с этими колонками
+        logger.info("Table result not found, skipping migration 011")
+        return
+
+    fields_to_add = [
+        ('test_questions_json', 'TEXT'),
+        ('test_questions_status', 'TEXT'),
+        ('test_questions_started_at', 'TIMESTAMP')
+    ]
+
+    for field_name, field_definition in fields_to_add:
+        if field_name not in columns:
+            c.execute(f'ALTER TABLE result ADD COLUMN {field_name} {field_definition}')
+            logger.info(f"Added {field_name} column to result table")
+
+def down(conn):
+    """Откат миграции (не поддерживается для ALTER TABLE ADD COLUMN)"""
+    logger.warning("Rollback not supported for this migration")
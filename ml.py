@@ -55,7 +55,7 @@ openai_client = None
 
 def load_models():
     """Загрузка моделей"""
-    global sentence_model, whisper_model, openai_client
+    global sentence_model, whisper_model
     
     logger.info("Loading models...")
     
@@ -76,14 +76,22 @@ def load_models():
     except Exception as e:
         logger.warning(f"Whisper model not loaded: {str(e)}")
     
-    # OpenAI клиент
-    api_key = os.environ.get('OPENAI_API_KEY')
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY environment variable not set")
-    openai_client = OpenAI(api_key=api_key)
+    # OpenAI клиент (общий, с таймаутом и повторами)
+    get_openai_client()
     
     logger.info("Models loaded successfully")
 
+def get_openai_client():
+    """Получение общего клиента OpenAI без загрузки локальных моделей"""
+    global openai_client
+    if openai_client is None:
+        api_key = os.environ.get('OPENAI_API_KEY')
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable not set")
+        # Клиент держит пул keep-alive соединений, поэтому создается один раз на процесс
+        openai_client = OpenAI(api_key=api_key, timeout=60, max_retries=2)
+    return openai_client
+
 try:
     load_models()
 except Exception as e:
@@ -935,8 +943,7 @@ def extract_meaningful_examples(paragraphs: List[str]) -> List[str]:
 def get_chat_response(user_message: str, full_text: str, result_data: Dict[str, Any]) -> str:
     """Получение ответа от ChatGPT на основе текста лекции"""
     try:
-        if not openai_client:
-            load_models()
+        client = get_openai_client()
         
         # Ограничиваем размер текста для контекста
         max_context_chars = 100000
@@ -975,7 +982,7 @@ def get_chat_response(user_message: str, full_text: str, result_data: Dict[str,
 
 Пожалуйста, ответь на вопрос студента, опираясь на содержание лекции."""
 
-        response = openai_client.chat.completions.create(
+        response = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -0,0 +1,114 @@
+"""
+Общие настройки тестов: импорт модулей приложения из корня репозитория
+и база данных в том виде, в каком ее получает рабочее окружение
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Модули приложения открывают ai_study.db и app.log по относительному пути:
+# тесты работают во временном каталоге, чтобы не трогать базу разработчика
+os.chdir(tempfile.mkdtemp(prefix='ai_study_tests_'))
+
+# Таблицы в том виде, в каком их создавала выпущенная версия init_db
+# (без уникального индекса прогресса и без статуса генерации вопросов)
+LEGACY_SCHEMA = '''
+    CREATE TABLE result (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT NOT NULL,
+        file_type TEXT NOT NULL,
+        topics_json TEXT NOT NULL,
+        summary TEXT NOT NULL,
+        flashcards_json TEXT NOT NULL,
+        mind_map_json TEXT,
+        study_plan_json TEXT,
+        quality_json TEXT,
+        video_segments_json TEXT,
+        key_moments_json TEXT,
+        full_text TEXT,
+        user_id INTEGER,
+        access_token TEXT UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        test_questions_json TEXT
+    );
+    CREATE TABLE user_progress (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        result_id INTEGER,
+        flashcard_id INTEGER,
+        user_id INTEGER,
+        last_review TIMESTAMP,
+        next_review TIMESTAMP,
+        ease_factor REAL DEFAULT 2.5,
+        consecutive_correct INTEGER DEFAULT 0
+    );
+    CREATE TABLE chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        result_id INTEGER,
+        user_id INTEGER,
+        user_message TEXT NOT NULL,
+        ai_response TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+'''
+
+# Миграции, которые приводят эти таблицы к текущей схеме
+SCHEMA_MIGRATIONS = ('010_add_user_progress_unique', '011_add_test_questions_status')
+
+def apply_schema_migrations(path):
+    """Применение миграций так же, как migration_manager.py migrate"""
+    from migration_manager import MigrationManager
+    manager = MigrationManager(db_path=path, migrations_dir=os.path.join(ROOT, 'migrations'))
+    for migration_name in SCHEMA_MIGRATIONS:
+        manager.apply_migration(migration_name)
+
+@pytest.fixture
+def migrate():
+    """Применение миграций схемы к базе по пути"""
+    return apply_schema_migrations
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    """Путь к базе со схемой выпущенной версии, еще без миграций"""
+    path = str(tmp_path / 'ai_study.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+    return path
+
+@pytest.fixture
+def db_path(legacy_db, monkeypatch):
+    """База после миграций; пул соединений приложения направлен на нее"""
+    import app
+    import db
+    
+    apply_schema_migrations(legacy_db)
+    db.close_pool()
+    monkeypatch.setattr(db, 'DB_PATH', legacy_db)
+    app._result_cache.clear()
+    yield legacy_db
+    db.close_pool()
+    app._result_cache.clear()
+
+@pytest.fixture
+def make_result(db_path):
+    """Создание записи результата; возвращает ее id"""
+    def make(test_questions_json=None, user_id=None):
+        conn = sqlite3.connect(db_path)
+        result_id = conn.execute('''
+            INSERT INTO result (filename, file_type, topics_json, summary, flashcards_json,
+                                mind_map_json, study_plan_json, quality_json,
+                                video_segments_json, key_moments_json, full_text,
+                                user_id, test_questions_json)
+            VALUES ('lecture.pdf', '.pdf', '{}', 'summary', '[]', '{}', '{}', '{}', '[]', '[]',
+                    'text', ?, ?)
+        ''', (user_id, test_questions_json)).lastrowid
+        conn.commit()
+        conn.close()
+        return result_id
+    return make
@@ -0,0 +1,52 @@
+"""
+Тесты пакетной записи истории чата
+"""
+import sqlite3
+
+import pytest
+
+import app
+
+@pytest.fixture
+def awarded(monkeypatch):
+    """Сообщения, за которые начислен XP, и число строк истории на момент начисления"""
+    calls = []
+    
+    def award(rows):
+        conn = sqlite3.connect(app.db.DB_PATH)
+        count, = conn.execute('SELECT COUNT(*) FROM chat_history').fetchone()
+        conn.close()
+        calls.extend((row[2], count) for row in rows)
+    
+    monkeypatch.setattr(app, '_award_chat_xp', award)
+    return calls
+
+def test_messages_are_written_in_order_before_xp(db_path, make_result, awarded):
+    result_id = make_result()
+    
+    for i in range(3):
+        app.save_chat_message(result_id, 1, f'question {i}', f'answer {i}')
+    app._drain_chat_history()
+    
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('''
+        SELECT user_message, ai_response FROM chat_history
+        WHERE result_id = ? ORDER BY created_at, id
+    ''', (result_id,)).fetchall()
+    conn.close()
+    assert rows == [(f'question {i}', f'answer {i}') for i in range(3)]
+    
+    # XP начисляется только за сообщения, уже видимые в chat_history
+    assert [message for message, _ in awarded] == [f'question {i}' for i in range(3)]
+    for i, (_, count) in enumerate(awarded):
+        assert count >= i + 1
+
+def test_writer_restarts_after_drain(db_path, make_result, awarded):
+    result_id = make_result()
+    
+    app.save_chat_message(result_id, 1, 'first', 'answer')
+    app._drain_chat_history()
+    app.save_chat_message(result_id, 1, 'second', 'answer')
+    app._drain_chat_history()
+    
+    assert [message for message, _ in awarded] == ['first', 'second']
@@ -0,0 +1,33 @@
+"""
+Тесты вспомогательных функций разбора пользовательского ввода
+"""
+import pytest
+
+from app import is_valid_email, parse_page_range
+
+@pytest.mark.parametrize('page_range, expected', [
+    ('5', ((5, 5),)),
+    ('1-3', ((1, 3),)),
+    ('3-1', ((1, 3),)),
+    (' 1 - 3 , 7 ', ((1, 3), (7, 7))),
+    ('10-12,1-5,4-8', ((1, 8), (10, 12))),
+    ('1-3,4', ((1, 4),)),
+])
+def test_parse_page_range(page_range, expected):
+    assert parse_page_range(page_range) == expected
+
+@pytest.mark.parametrize('page_range', ['', 'a', '1-', '-3', '1,,2', '1-2-3'])
+def test_parse_page_range_rejects_invalid_format(page_range):
+    with pytest.raises(ValueError):
+        parse_page_range(page_range)
+
+@pytest.mark.parametrize('email', ['user@example.com', 'first.last+tag@mail.example.ru', 'a_b%c@d-e.org'])
+def test_valid_emails(email):
+    assert is_valid_email(email)
+
+@pytest.mark.parametrize('email', [
+    '', 'user', 'user@', '@example.com', 'user@example', 'user@example.c0m',
+    'us er@example.com', 'user@exam ple.com', 'почта@example.com', 'a' * 250 + '@example.com',
+])
+def test_invalid_emails(email):
+    assert not is_valid_email(email)
@@ -0,0 +1,55 @@
+"""
+Тесты строки результата с ленивым разбором JSON-колонок
+"""
+import orjson
+
+from app import LazyJSONRow
+
+def make_row():
+    """Строка, в которой ни одна JSON-колонка еще не разобрана"""
+    return LazyJSONRow(
+        {'filename': 'lecture.pdf', 'full_text': 'text', 'page_info': {'total_pages': 3}},
+        {'flashcards': '[{"q": "Q1", "a": "A1"}]', 'topics_data': '{"main_topics": []}'}
+    )
+
+def test_unparsed_row_serializes_all_columns():
+    row = make_row()
+    expected = {
+        'filename': 'lecture.pdf',
+        'full_text': 'text',
+        'page_info': {'total_pages': 3},
+        'flashcards': [{'q': 'Q1', 'a': 'A1'}],
+        'topics_data': {'main_topics': []},
+    }
+    
+    assert dict(make_row()) == expected
+    assert {**make_row()} == expected
+    assert orjson.loads(orjson.dumps(dict(row))) == expected
+
+def test_keys_and_membership_include_unparsed_columns():
+    row = make_row()
+    
+    assert 'flashcards' in row
+    assert len(row) == 5
+    assert set(row) == {'filename', 'full_text', 'page_info', 'flashcards', 'topics_data'}
+    assert row.get('missing') is None
+
+def test_copies_do_not_share_parsed_values():
+    cached = make_row()
+    first = cached.copy()
+    first['flashcards'].append({'q': 'Q2', 'a': 'A2'})
+    first['page_info']['total_pages'] = 10
+    
+    second = cached.copy()
+    assert second['flashcards'] == [{'q': 'Q1', 'a': 'A1'}]
+    assert second['page_info'] == {'total_pages': 3}
+
+def test_set_and_delete_unparsed_column():
+    row = make_row()
+    del row['topics_data']
+    row['flashcards'] = []
+    row['id'] = 7
+    
+    assert 'topics_data' not in row
+    assert dict(row)['flashcards'] == []
+    assert row['id'] == 7
@@ -0,0 +1,157 @@
+"""
+Тесты режима тестирования: запись ответов (UPSERT прогресса по SM-2)
+и фоновая генерация вопросов
+"""
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import app
+
+USER_ID = 1
+
+def read_progress(db_path, result_id):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('''
+        SELECT flashcard_id, consecutive_correct, ease_factor
+        FROM user_progress WHERE result_id = ? AND user_id = ?
+        ORDER BY flashcard_id
+    ''', (result_id, USER_ID)).fetchall()
+    conn.close()
+    return rows
+
+def days_from_today(days):
+    return (datetime.now(timezone.utc) + timedelta(days=days)).strftime('%Y-%m-%d')
+
+def test_correct_answers_follow_sm2_intervals(db_path, make_result):
+    result_id = make_result()
+    
+    for streak, interval in ((1, 1), (2, 6), (3, 5), (4, 7)):
+        progress, = app.apply_test_answers(result_id, USER_ID, [(0, True)])
+        assert progress == {
+            'consecutive_correct': streak,
+            'next_review': days_from_today(interval),
+            'ease_factor': 2.5
+        }
+    
+    # Повторные ответы обновляют одну и ту же запись
+    assert read_progress(db_path, result_id) == [(0, 4, 2.5)]
+
+def test_wrong_answer_resets_streak_and_lowers_ease(db_path, make_result):
+    result_id = make_result()
+    app.apply_test_answers(result_id, USER_ID, [(0, True), (0, True)])
+    
+    progress, = app.apply_test_answers(result_id, USER_ID, [(0, False)])
+    
+    assert progress == {'consecutive_correct': 0, 'next_review': days_from_today(1), 'ease_factor': 2.3}
+    assert read_progress(db_path, result_id) == [(0, 0, pytest.approx(2.3))]
+
+def test_batch_continues_from_updated_progress(db_path, make_result):
+    result_id = make_result()
+    
+    results = app.apply_test_answers(result_id, USER_ID, [(0, True), (1, False), (0, True), ('1', True)])
+    
+    assert [r['consecutive_correct'] for r in results] == [1, 0, 2, 1]
+    assert read_progress(db_path, result_id) == [(0, 2, 2.5), (1, 1, pytest.approx(2.3))]
+
+def test_migration_keeps_latest_duplicate_progress(legacy_db, migrate):
+    conn = sqlite3.connect(legacy_db)
+    conn.executemany('''
+        INSERT INTO user_progress (result_id, flashcard_id, user_id, consecutive_correct)
+        VALUES (?, ?, ?, ?)
+    ''', [(1, 0, USER_ID, 1), (1, 0, USER_ID, 2), (1, 1, USER_ID, 5)])
+    conn.commit()
+    conn.close()
+    
+    migrate(legacy_db)
+    
+    conn = sqlite3.connect(legacy_db)
+    assert conn.execute('''
+        SELECT flashcard_id, consecutive_correct FROM user_progress ORDER BY flashcard_id
+    ''').fetchall() == [(0, 2), (1, 5)]
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute('INSERT INTO user_progress (result_id, flashcard_id, user_id) VALUES (1, 0, ?)', (USER_ID,))
+    conn.close()
+
+class RecordingExecutor:
+    """Пул потоков, который только запоминает поставленные задачи"""
+    
+    def __init__(self):
+        self.submitted = []
+    
+    def submit(self, fn, *args):
+        self.submitted.append(args)
+
+@pytest.fixture
+def executor(monkeypatch):
+    executor = RecordingExecutor()
+    monkeypatch.setattr(app, '_test_gen_executor', executor)
+    return executor
+
+@pytest.fixture
+def client(db_path):
+    return app.app.test_client()
+
+def generation_status(client, result_id):
+    return client.get(f'/test/{result_id}/status').get_json()['status']
+
+def set_generation_state(db_path, result_id, status, started_at):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''
+        UPDATE result SET test_questions_status = ?, test_questions_started_at = ? WHERE id = ?
+    ''', (status, started_at, result_id))
+    conn.commit()
+    conn.close()
+
+def test_generation_is_claimed_once(executor, client, make_result):
+    result_id = make_result()
+    
+    assert app.start_test_questions_generation(result_id, {}) is True
+    assert app.start_test_questions_generation(result_id, {}) is False
+    assert len(executor.submitted) == 1
+    assert generation_status(client, result_id) == 'generating'
+
+def test_generation_is_not_started_when_questions_exist(executor, make_result):
+    result_id = make_result(test_questions_json='[{"question": "Q?"}]')
+    
+    assert app.start_test_questions_generation(result_id, {}) is False
+    assert executor.submitted == []
+
+def test_empty_questions_are_not_ready(executor, client, make_result):
+    result_id = make_result(test_questions_json='[]')
+    
+    assert generation_status(client, result_id) == 'generating'
+    assert app.start_test_questions_generation(result_id, {}) is True
+
+def test_failed_generation_can_be_retried(executor, client, db_path, make_result, monkeypatch):
+    result_id = make_result()
+    monkeypatch.setattr(app, 'generate_test_questions', lambda result_data: [])
+    
+    app.start_test_questions_generation(result_id, {})
+    app._generate_test_questions_task(result_id, {})
+    
+    assert generation_status(client, result_id) == 'failed'
+    assert app.start_test_questions_generation(result_id, {}) is True
+    assert generation_status(client, result_id) == 'generating'
+
+def test_stale_generation_is_reported_failed_and_reclaimed(executor, client, db_path, make_result):
+    result_id = make_result()
+    set_generation_state(db_path, result_id, 'generating', '2000-01-01 00:00:00')
+    
+    assert generation_status(client, result_id) == 'failed'
+    assert app.start_test_questions_generation(result_id, {}) is True
+
+def test_saved_questions_are_ready(executor, client, db_path, make_result, monkeypatch):
+    result_id = make_result()
+    questions = [{'question': 'Q?', 'options': {'A': '1', 'B': '2'}, 'correct_answer': 'A'}]
+    monkeypatch.setattr(app, 'generate_test_questions', lambda result_data: questions)
+    
+    app.start_test_questions_generation(result_id, {})
+    app._generate_test_questions_task(result_id, {})
+    
+    assert generation_status(client, result_id) == 'ready'
+    assert app.get_result(result_id, check_access=False)['test_questions'] == questions
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT test_questions_status FROM result WHERE id = ?', (result_id,)).fetchone() == (None,)
+    conn.close()